@@ -0,0 +1,245 @@
+"""
+Animations of an IFS, rendered as numbered PNG frames.
+
+Each keyframe is the IFS at a frame number, as saved by IFS.parameters (or
+in a parameters file from IFSI.save_parameters). In between, every number
+of the transforms is interpolated linearly: the coefficients of Linear,
+Moebius and the Moebius base form, the c of InverseJulia, the colours and
+the weights. Each frame's points carry on from where the last frame's
+ended up, so they are already on the attractor and need little burn-in.
+
+Frames are rendered in chunks of consecutive frames, the points carrying on
+only within a chunk, so chunks can be rendered on a pool of processes. The
+frames come out in order either way, and don't depend on the number of
+workers. For example
+
+    python3 animation.py -o frames/flame.png -j 8 0:start.json 120:middle.json 240:end.json
+"""
+import getopt, json, multiprocessing, numpy, os, sys
+from ifs import IFSI
+
+
+# Consecutive frames rendered by one worker, their points carrying on
+ANIMATION_CHUNK_FRAMES = 12
+
+# Iterations to burn in for the first frame of a chunk, and for frames that
+# carry on from the frame before
+CHUNK_BURN_IN = 20
+FRAME_BURN_IN = 3
+
+
+def interpolate(a, b, t):
+    """
+    Linear interpolation between two sets of parameters of the same shape,
+    a at t = 0 and b at t = 1. Numbers are interpolated, and anything else,
+    such as the class of a transform, must be the same in both.
+    """
+    if isinstance(a, dict):
+        if a.keys() != b.keys():
+            raise ValueError("Keyframes need the same transforms in the same order")
+        return {k: interpolate(a[k], b[k], t) for k in a}
+    if isinstance(a, list):
+        if len(a) != len(b):
+            raise ValueError("Keyframes need the same transforms in the same order")
+        return [interpolate(x, y, t) for x, y in zip(a, b)]
+    if isinstance(a, (int, float)) and not isinstance(a, bool):
+        return a + (b - a) * t
+    if a != b:
+        raise ValueError("Keyframes need the same transforms in the same order")
+    return a
+
+
+def frame_parameters(keyframes, frame):
+    """
+    The IFS parameters at a frame, from a list of (frame, parameters)
+    keyframes sorted by frame. Before the first keyframe and after the last
+    they stay as they are.
+    """
+    if frame <= keyframes[0][0]:
+        return keyframes[0][1]
+    for (f0, p0), (f1, p1) in zip(keyframes, keyframes[1:]):
+        if frame <= f1:
+            return interpolate(p0, p1, (frame - f0) / float(f1 - f0))
+    return keyframes[-1][1]
+
+
+def load_keyframes(frames_and_paths):
+    """
+    Keyframes from (frame, path) pairs of parameters files saved by
+    IFSI.save_parameters, along with the IFSI parameters of the first, for
+    the size, samples and seed of the animation
+    """
+    keyframes, first = [], None
+    for frame, path in sorted(frames_and_paths):
+        with open(path) as f:
+            params = json.load(f)["parameters"]
+        keyframes.append((frame, params["ifs"]))
+        if first is None:
+            first = params
+    return keyframes, first
+
+
+def render_chunk(job):
+    """
+    Render a chunk of frames of an animation in a worker process
+    """
+    animation, frames = job
+    return list(animation.render_frames(frames))
+
+
+class Animation:
+    """
+    Animation from keyframes of IFS parameters, with every frame rendered by
+    the numpy engine at the given size and samples. The seed seeds the
+    points, with a stream of its own for each frame. The first frame of each
+    chunk burns in for burn_in iterations, and the rest for frame_burn_in.
+    Frame number n is saved as filename with _n, padded to 5 digits, before
+    the extension, e.g. flame_00042.png.
+    """
+    def __init__(self, keyframes, width, height, iterations, num_points, seed, filename,
+                 burn_in=CHUNK_BURN_IN, frame_burn_in=FRAME_BURN_IN, reseed=False, oversample=1,
+                 chunk=ANIMATION_CHUNK_FRAMES, save=None):
+        self.keyframes = sorted(keyframes, key=lambda k: k[0])
+        self.width = width
+        self.height = height
+        self.iterations = iterations
+        self.num_points = num_points
+        self.seed = seed
+        self.filename = filename
+        self.burn_in = burn_in
+        self.frame_burn_in = frame_burn_in
+        self.reseed = reseed
+        self.oversample = oversample
+        self.chunk = chunk
+        self.save = save or {}
+        self.frames = range(self.keyframes[0][0], self.keyframes[-1][0] + 1)
+
+    def frame_filename(self, frame):
+        root, ext = os.path.splitext(self.filename)
+        return "%s_%05d%s" % (root, frame, ext or ".png")
+
+    def frame(self, frame, start=None):
+        """
+        IFSI for one frame, with its points starting from start, the points
+        and colours the frame before ended with, if given
+        """
+        ifsi = IFSI(self.width, self.height, self.iterations, self.num_points, 0, 0, 0, self.seed,
+                    filename=self.frame_filename(frame),
+                    burn_in=self.burn_in if start is None else self.frame_burn_in,
+                    reseed=self.reseed, oversample=self.oversample,
+                    ifs=frame_parameters(self.keyframes, frame))
+        ifsi.set_stream(numpy.random.SeedSequence(self.seed, spawn_key=(frame,)))
+        if start is not None:
+            ifsi.start_from(*start)
+        return ifsi
+
+    def render_frames(self, frames):
+        """
+        Render and save consecutive frames, the points of each carrying on
+        from the one before, yielding (frame, filename) as each is saved,
+        or (frame, False) if it was degenerate
+        """
+        start = None
+        for frame in frames:
+            ifsi = self.frame(frame, start)
+            if ifsi.render(bar=False, engine="numpy"):
+                ifsi.save_image(**self.save)
+                rng, points, colours, zero_count, skip = ifsi.walkers
+                start = (points, colours)
+                yield frame, ifsi.filename
+            else:
+                start = None
+                yield frame, False
+
+    def chunks(self):
+        return [self.frames[i:i + self.chunk] for i in range(0, len(self.frames), self.chunk)]
+
+    def render(self, workers=1):
+        """
+        Render every frame, yielding (frame, filename), or (frame, False)
+        if it was degenerate, in order of frame as soon as each and all
+        those before it are saved. With more than one worker, chunks of
+        frames are rendered on a pool of processes.
+        """
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                for part in pool.imap(render_chunk, [(self, frames) for frames in self.chunks()]):
+                    yield from part
+        else:
+            for frames in self.chunks():
+                yield from self.render_frames(frames)
+
+
+def print_help():
+    print("""
+    Usage: animation.py [options] FRAME:PARAMETERS.json ...
+
+    Each keyframe is a frame number and a parameters file saved with the
+    image it came from. The size, samples and seed of the first are used
+    unless given here.
+
+    -?, --help: Display this list
+    -o, --output: Filename for the frames, numbered before the extension (default: frames/frame.png)
+    -w, --width: Frame width
+    -h, --height: Frame height
+    -i, --iterations: Iterations of each point per frame
+    -n, --num-points: Number of points
+    -j, --workers: Number of processes to render chunks of frames with
+    --burn-in: Iterations to burn in at the start of each chunk (default: %d)
+    --frame-burn-in: Iterations to burn in for frames carrying on from the one before (default: %d)
+    --chunk: Consecutive frames in a chunk (default: %d)
+    --blur: Largest radius of density estimation filtering, or 0 for none
+    """ % (CHUNK_BURN_IN, FRAME_BURN_IN, ANIMATION_CHUNK_FRAMES))
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "?o:w:h:i:n:j:",
+                     ["help","output=","width=","height=","iterations=","num-points=","workers=",
+                      "burn-in=","frame-burn-in=","chunk=","blur="])
+        keyframes, first = load_keyframes([(int(frame), path) for frame, path in
+                                           (arg.split(":", 1) for arg in args)])
+    except (getopt.error, ValueError, OSError) as msg:
+        sys.stdout = sys.stderr
+        print(msg)
+        print_help()
+        sys.exit(2)
+
+    if not keyframes:
+        print_help()
+        sys.exit(2)
+    options = {"filename": os.path.join("frames", "frame.png"),
+               "reseed": first["reseed"], "oversample": first["oversample"]}
+    for name in ("width", "height", "iterations", "num_points", "seed"):
+        options[name] = first[name]
+    workers = 1
+    for opt, arg in opts:
+        if opt in ["-?","--help"]:
+            print_help()
+            sys.exit(0)
+        if opt in ["-o","--output"]:
+            options["filename"] = arg
+        if opt in ["-w","--width"]:
+            options["width"] = int(arg)
+        if opt in ["-h","--height"]:
+            options["height"] = int(arg)
+        if opt in ["-i","--iterations"]:
+            options["iterations"] = int(arg)
+        if opt in ["-n","--num-points"]:
+            options["num_points"] = int(arg)
+        if opt in ["-j","--workers"]:
+            workers = int(arg)
+        if opt in ["--burn-in"]:
+            options["burn_in"] = int(arg)
+        if opt in ["--frame-burn-in"]:
+            options["frame_burn_in"] = int(arg)
+        if opt in ["--chunk"]:
+            options["chunk"] = int(arg)
+        if opt in ["--blur"]:
+            options["save"] = {"blur": int(arg)}
+
+    directory = os.path.dirname(options["filename"])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    for frame, filename in Animation(keyframes, **options).render(workers):
+        print(filename or "Frame %d was degenerate" % frame)
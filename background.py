@@ -0,0 +1,101 @@
+"""
+Rendering and seed searches in background threads, so the GUI stays
+responsive and can show the image building up
+"""
+import threading, time, traceback
+
+
+# Seconds between snapshots of a render in progress sent to the window
+SNAPSHOT_INTERVAL = 0.5
+
+# Largest width or height of the snapshots
+SNAPSHOT_SIZE = 400
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a render to stop it
+    """
+
+
+class BackgroundRender(threading.Thread):
+    """
+    Render an IFSI in a background thread, sending events to a PySimpleGUI
+    window: "render-snapshot" with (self, progress, total, preview), where
+    preview is a get_image array of the image so far, every
+    SNAPSHOT_INTERVAL seconds, then "render-done" with (self, ifsi), or
+    (self, False) if it was degenerate, cancelled or failed, with the
+    exception it failed with left in self.error. Each event carries the
+    BackgroundRender, so events from a render that has been replaced can
+    be ignored.
+
+    The render reports its progress here as if to a progress bar, which is
+    where snapshots are taken and cancelling stops it. Given save options,
+    the image is saved with them before it is reported done.
+    """
+    def __init__(self, ifsi, window, save=None, **options):
+        super(BackgroundRender, self).__init__(daemon=True)
+        self.ifsi = ifsi
+        self.window = window
+        self.save = save
+        self.options = options
+        self.cancelled = threading.Event()
+        self.last_snapshot = 0.0
+        self.error = None
+
+    def cancel(self):
+        """
+        Stop the render at its next progress report
+        """
+        self.cancelled.set()
+
+    def UpdateBar(self, progress, total=None):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        now = time.time()
+        if now - self.last_snapshot >= SNAPSHOT_INTERVAL:
+            self.last_snapshot = now
+            self.window.write_event_value("render-snapshot",
+                                          (self, progress, total, self.ifsi.get_image(SNAPSHOT_SIZE)))
+
+    def run(self):
+        result = False
+        try:
+            if self.ifsi.render(bar=self, **self.options):
+                if self.save is not None:
+                    self.ifsi.save_image(**self.save)
+                result = self.ifsi
+        except Cancelled:
+            pass
+        except Exception as e:
+            # Report it rather than let the thread die without render-done
+            traceback.print_exc()
+            self.error = e
+        self.window.write_event_value("render-done", (self, result))
+
+
+class BackgroundSeedSearch(threading.Thread):
+    """
+    Search for a seed with get_seed in a background thread, sending the
+    event "seed-found" with (self, seed) to a PySimpleGUI window when one
+    passes, or (self, None) if the search failed, with the exception left in
+    self.error. A search can't be stopped partway, so the window should ignore
+    the result of one it no longer wants.
+    """
+    def __init__(self, window, num_transforms, moebius_chance, spherical_chance):
+        super(BackgroundSeedSearch, self).__init__(daemon=True)
+        self.window = window
+        self.num_transforms = num_transforms
+        self.moebius_chance = moebius_chance
+        self.spherical_chance = spherical_chance
+        self.error = None
+
+    def run(self):
+        from ifs import get_seed
+        seed = None
+        try:
+            seed = get_seed(self.num_transforms, self.moebius_chance, self.spherical_chance)
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+        self.window.write_event_value("seed-found", (self, seed))
@@ -1,9 +1,69 @@
-from colour import Color
 from math import sqrt
+import numpy
+
+
+# Transform classes an IFS can be made of, by name, and the lists of them
+# chosen from for each exclude and include, made when first needed
+TRANSFORMS = {}
+CHOICES = {}
+
+
+def register(cls):
+    """
+    Class decorator adding a transform to TRANSFORMS, including ones written
+    outside transforms.py, which just need registering before an IFS is made
+    """
+    TRANSFORMS[cls.__name__] = cls
+    CHOICES.clear()
+    return cls
+
+
+def transform_choices(exclude=(), include=()):
+    """
+    The registered transform classes, sorted by name, without those named in
+    exclude and, if include isn't empty, only those named in it
+    """
+    key = (frozenset(exclude), frozenset(include))
+    if key not in CHOICES:
+        CHOICES[key] = [cls for name, cls in sorted(TRANSFORMS.items())
+                        if name not in key[0] and (not key[1] or name in key[1])]
+    return CHOICES[key]
+
+
+def hue_rgb(h):
+    """
+    Red, green and blue of the brightest fully saturated colour of hue h,
+    from 0 to 1, exactly as colour.Color(hsl=(h, 1, 0.5)).rgb works it out
+    """
+    h = float(h)
+    return _hue_channel(h + 1.0 / 3), _hue_channel(h), _hue_channel(h - 1.0 / 3)
+
+
+def _hue_channel(h):
+    while h < 0:
+        h += 1
+    while h > 1:
+        h -= 1
+    if 6 * h < 1:
+        return 6 * h
+    if 2 * h < 1:
+        return 1.0
+    if 3 * h < 2:
+        return ((2.0 / 3) - h) * 6
+    return 0.0
+
 
 class Transform(object):
+    """
+    Transforms keep their parameters in __slots__, rather than an instance
+    dict, which makes them smaller and their attributes quicker to look up.
+    Subclasses should list theirs in __slots__ too, though ones that don't
+    still work.
+    """
+    __slots__ = ("r", "g", "b", "rng")
+
     def __init__(self, rng):
-        self.r, self.g, self.b = Color(hsl=(rng.random(), 1, 0.5)).rgb
+        self.r, self.g, self.b = hue_rgb(rng.random())
         self.rng = rng
 
     def transform_colour(self, r, g, b):
@@ -15,18 +75,101 @@ class Transform(object):
     def get_name(self):
         return self.__class__.__name__
 
+    def fields(self):
+        """
+        Names of the attributes of this transform that are set, from the
+        __slots__ of each class, base classes first, then any instance dict
+        """
+        for cls in reversed(type(self).__mro__):
+            for name in cls.__dict__.get("__slots__", ()):
+                if hasattr(self, name):
+                    yield name
+        yield from getattr(self, "__dict__", ())
+
+    def set_rng(self, rng):
+        """
+        Use rng for any randomness, here and in any transform this one wraps
+        """
+        self.rng = rng
+        if hasattr(self, "xform"):
+            self.xform.set_rng(rng)
+
+    def parameters(self):
+        """
+        The class and numbers that make up this transform, including any
+        transform it wraps, as a dict that can be saved as JSON
+        """
+        params = {"class": self.__class__.__name__}
+        for name in self.fields():
+            value = getattr(self, name)
+            if name == "xform":
+                params[name] = value.parameters()
+            elif isinstance(value, complex):
+                params[name] = {"complex": [value.real, value.imag]}
+            elif isinstance(value, (int, float)):
+                params[name] = value
+        return params
+
+    def set_parameters(self, params, load):
+        """
+        Set the numbers saved by parameters, using load to recreate any
+        transform this one wraps
+        """
+        for name, value in params.items():
+            if name == "xform":
+                value = load(value)
+            elif isinstance(value, dict):
+                value = complex(*value["complex"])
+            if name != "class":
+                setattr(self, name, value)
+
+    def transform_array(self, px, py, rng):
+        """
+        Transform numpy arrays of points at once, using the numpy generator rng
+        for any randomness. This fallback loops over the points in Python, so
+        subclasses should override it with real array code.
+        """
+        out = numpy.empty((2, len(px)))
+        for i in range(len(px)):
+            try:
+                out[:, i] = self.transform(px[i], py[i])
+            except (ZeroDivisionError, OverflowError, ValueError):
+                out[:, i] = numpy.nan
+        return out[0], out[1]
+
 
 class ComplexTransform(Transform):
+    __slots__ = ()
+
     def transform(self, px, py):
         z = complex(px, py)
         z2 = self.f(z)
         return z2.real, z2.imag
 
+    def transform_array(self, px, py, rng):
+        z2 = self.f_array(px + 1j * py, rng)
+        return z2.real, z2.imag
+
+    def f_array(self, z, rng):
+        """
+        Apply f to a numpy array of complex numbers. Like transform_array, this
+        fallback loops in Python and should be overridden.
+        """
+        out = numpy.empty(len(z), dtype=complex)
+        for i in range(len(z)):
+            try:
+                out[i] = self.f(complex(z[i]))
+            except (ZeroDivisionError, OverflowError, ValueError):
+                out[i] = complex(numpy.nan, numpy.nan)
+        return out
+
 
 class MoebiusBase(ComplexTransform):
     """
     This applies a random Moebius transform and then its inverse.
     """
+    __slots__ = ("coef_a", "coef_b", "coef_c", "coef_d", "xform", "transform_colour")
+
     def __init__(self, rng, xform):
         super(MoebiusBase, self).__init__(rng)
         self.coef_a = complex(rng.gauss(0, 0.2), rng.gauss(0, 0.2))
@@ -39,6 +182,10 @@ class MoebiusBase(ComplexTransform):
     def get_name(self):
         return "Moeb" + self.xform.get_name()
 
+    def set_parameters(self, params, load):
+        super(MoebiusBase, self).set_parameters(params, load)
+        self.transform_colour = self.xform.transform_colour
+
     def f(self, z):
         # apply pre-Moebius (az+b)/(cz+d)
         z = (self.coef_a * z + self.coef_b) / (self.coef_c * z + self.coef_d)
@@ -49,11 +196,19 @@ class MoebiusBase(ComplexTransform):
         # return post-Moebius (dz-b)/(-cz+a), which is inverse of pre-Moebius
         return (self.coef_d * z - self.coef_b) / (-self.coef_c * z + self.coef_a)
 
+    def f_array(self, z, rng):
+        z = (self.coef_a * z + self.coef_b) / (self.coef_c * z + self.coef_d)
+        px, py = self.xform.transform_array(z.real, z.imag, rng)
+        z = px + 1j * py
+        return (self.coef_d * z - self.coef_b) / (-self.coef_c * z + self.coef_a)
+
 
 class SphericalBase(Transform):
     """
     Since the spherical transform is its own inverse, it can simply be applied twice.
     """
+    __slots__ = ("xform",)
+
     def __init__(self, rng, xform):
         super(SphericalBase, self).__init__(rng)
         self.xform = xform
@@ -63,12 +218,18 @@ class SphericalBase(Transform):
 
     def transform(self, px, py):
         # first spherical
-        r2 = sqrt(px**2 + py**2)**2
+        r2 = sqrt(px*px + py*py)**2
         px, py = px/r2, py/r2
 
         # inner transform
         px, py = self.xform.transform(px, py)
 
         # second spherical
-        r2 = sqrt(px**2 + py**2)**2
+        r2 = sqrt(px*px + py*py)**2
+        return px/r2, py/r2
+
+    def transform_array(self, px, py, rng):
+        r2 = px**2 + py**2
+        px, py = self.xform.transform_array(px/r2, py/r2, rng)
+        r2 = px**2 + py**2
         return px/r2, py/r2
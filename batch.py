@@ -0,0 +1,198 @@
+"""
+Batch rendering of many images for headless dataset generation.
+
+Seed search and rendering run as two pipelined stages, each on its own pool
+of worker processes. Every finished step is appended to a manifest file, so
+an interrupted batch picks up where it left off when run again.
+"""
+import functools, json, multiprocessing, os, queue, random, sys, time
+from ifs import get_seed, IFSI, RenderStats, SeedStats
+
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10.0
+
+
+class StageProgress:
+    """
+    Progress and throughput of one stage of the batch
+    """
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.busy = 0.0
+        self.start = time.time()
+
+    def update(self, seconds):
+        self.done += 1
+        self.busy += seconds
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        each = self.busy / self.done if self.done else 0.0
+        return "%-7s %6d/%-6d %7.2f/s %8.2f s each" % (
+            self.name, self.done, self.total, self.done / elapsed, each)
+
+
+def dataset_jobs(directory, subsets, width, height, iterations, num_points,
+                 num_transforms, moebius_chance, spherical_chance, batch_seed=None,
+                 burn_in=0, reseed=False, oversample=1):
+    """
+    One job per image of each (subdirectory, count) subset. Each job gets its
+    own search seed, so a batch_seed makes the whole dataset reproducible.
+    """
+    rng = random.Random(batch_seed)
+    jobs = []
+    for subdir, count in subsets:
+        for i in range(count):
+            jobs.append({
+                "filename": os.path.join(directory, subdir, "ifs", "%03d" % i + ".png"),
+                "width": width, "height": height,
+                "iterations": iterations, "num_points": num_points,
+                "num_transforms": num_transforms, "moebius_chance": moebius_chance,
+                "spherical_chance": spherical_chance,
+                "burn_in": burn_in, "reseed": reseed, "oversample": oversample,
+                "search_seed": rng.randrange(sys.maxsize),
+            })
+    return jobs
+
+
+def read_manifest(path):
+    """
+    Latest manifest entry for each filename
+    """
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # partly written line from an interrupted batch
+                entries[entry["filename"]] = entry
+    return entries
+
+
+def search_job(job):
+    """
+    Find an interesting seed for the job
+    """
+    start = time.time()
+    stats = SeedStats()
+    job = dict(job, seed=get_seed(job["num_transforms"], job["moebius_chance"],
+                                  job["spherical_chance"], stats=stats,
+                                  rng=random.Random(job["search_seed"])))
+    job["search_seconds"] = time.time() - start
+    return job, stats, job["search_seconds"]
+
+
+def render_job(job, keep_stats=False, save=None, **options):
+    """
+    Render and save the job's image, returning False if it was degenerate,
+    along with the render's stats if they are being kept. Any save options,
+    such as previews, blur or hdr, are passed on to IFSI.save_image, and
+    any other options to IFSI.render.
+    """
+    start = time.time()
+    ifsi = IFSI(job["width"], job["height"], job["iterations"], job["num_points"],
+                job["num_transforms"], job["moebius_chance"], job["spherical_chance"],
+                job["seed"], filename=job["filename"],
+                stats=RenderStats() if keep_stats else None,
+                burn_in=job.get("burn_in", 0), reseed=job.get("reseed", False),
+                oversample=job.get("oversample", 1))
+    ok = bool(ifsi.render(bar=False, **options))
+    if ok:
+        ifsi.save_image(**(save or {}))
+    return job, (ok, ifsi.stats), time.time() - start
+
+
+def run_batch(jobs, manifest, search_workers=1, render_workers=1, stats_log=None, **options):
+    """
+    Run the jobs through seed search and rendering, skipping images that
+    already exist. Jobs the manifest shows as seeded go straight to
+    rendering, and images removed since they were rendered are replaced
+    using a new seed. If stats_log is given, the RenderStats of each render
+    are appended to it as JSON lines. Any options, such as the engine, a
+    time limit or save options, are passed on to render_job. Returns the seed search stats.
+    """
+    entries = read_manifest(manifest)
+    to_search, to_render = [], []
+    for job in jobs:
+        entry = entries.get(job["filename"], {})
+        status = entry.get("status")
+        if status is not None:
+            job = dict(job, search_seed=entry["search_seed"])
+        if status in (None, "rendered") and os.path.exists(job["filename"]):
+            # Keep existing images, as long as they were finished
+            continue
+        elif status == "rendered":
+            # Removed by hand, so replace it with a new image
+            to_search.append(dict(job, search_seed=job["search_seed"] + 1))
+        elif status == "seeded":
+            to_render.append(dict(job, seed=entry["seed"]))
+        else:
+            to_search.append(job)
+
+    stats = SeedStats()
+    search = StageProgress("search", len(to_search))
+    render = StageProgress("render", len(to_search) + len(to_render))
+    print("%d of %d images already rendered" % (len(jobs) - render.total, len(jobs)))
+    if render.total == 0:
+        return stats
+
+    directory = os.path.dirname(manifest)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    results = queue.Queue()
+    with open(manifest, "a") as log, \
+         multiprocessing.Pool(search_workers) as search_pool, \
+         multiprocessing.Pool(render_workers) as render_pool:
+
+        def submit(pool, stage, fn, job):
+            pool.apply_async(fn, (job,), callback=lambda r: results.put((stage, r)),
+                             error_callback=lambda e: results.put(("error", e)))
+
+        def record(job, status):
+            log.write(json.dumps(dict(job, status=status)) + "\n")
+            log.flush()
+
+        for job in to_search:
+            submit(search_pool, "search", search_job, job)
+        render_fn = functools.partial(render_job, keep_stats=stats_log is not None, **options)
+        for job in to_render:
+            submit(render_pool, "render", render_fn, job)
+
+        last_report = time.time()
+        while render.done < render.total:
+            stage, result = results.get()
+            if stage == "error":
+                raise result
+            elif stage == "search":
+                job, part, seconds = result
+                stats.merge(part)
+                search.update(seconds)
+                record(job, "seeded")
+                submit(render_pool, "render", render_fn, job)
+            else:
+                job, (ok, render_stats), seconds = result
+                if ok:
+                    render.update(seconds)
+                    record(job, "rendered")
+                    if stats_log is not None:
+                        if "search_seconds" in job:
+                            render_stats.stages["seed search"] = job["search_seconds"]
+                        render_stats.log(stats_log, filename=job["filename"], seed=job["seed"])
+                else:
+                    # Degenerate render, so search again from a new seed
+                    job = dict(job, search_seed=job["search_seed"] + 1)
+                    record(job, "degenerate")
+                    search.total += 1
+                    submit(search_pool, "search", search_job, job)
+
+            if time.time() - last_report >= REPORT_INTERVAL or render.done == render.total:
+                print(search.report() + " | " + render.report())
+                last_report = time.time()
+
+    return stats
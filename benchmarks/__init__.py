@@ -0,0 +1,7 @@
+"""
+Benchmarks of the hot paths of pyifs. Run them with
+
+    python -m benchmarks --output results.json
+
+from the top of the repository.
+"""
@@ -0,0 +1,56 @@
+import getopt, json, os, sys
+
+# Run from the top of the repository, where the pyifs modules live
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.suite import BENCHMARKS, compare, run
+
+def print_help():
+    print("""
+    -?, --help: Display this list
+    -o, --output: File to write the results to as JSON (default: print them)
+    -g, --group: Only run this group of benchmarks (transform, choose, iterate or image); may be repeated
+    -s, --scale: Multiply the size of every workload, e.g. 0.1 for a quick run
+    -r, --repeat: Number of runs of each benchmark to take the best of
+    -c, --compare: Earlier results file to compare these results with
+    """)
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "?o:g:s:r:c:",
+                 ["help","output=","group=","scale=","repeat=","compare="])
+except getopt.error as msg:
+    sys.stdout = sys.stderr
+    print(msg)
+    print_help()
+    sys.exit(2)
+
+output, groups, scale, repeat, baseline = None, [], 1.0, 3, None
+for opt, arg in opts:
+    if opt in ["-?","--help"]:
+        print_help()
+        sys.exit(0)
+    if opt in ["-o","--output"]:
+        output = arg
+    if opt in ["-g","--group"]:
+        if arg not in [group for group, bench in BENCHMARKS]:
+            print("Unknown benchmark group: " + arg, file=sys.stderr)
+            sys.exit(2)
+        groups.append(arg)
+    if opt in ["-s","--scale"]:
+        scale = float(arg)
+    if opt in ["-r","--repeat"]:
+        repeat = int(arg)
+    if opt in ["-c","--compare"]:
+        baseline = arg
+
+results = run(groups, scale, repeat, log=lambda msg: print(msg, file=sys.stderr))
+if output:
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+else:
+    print(json.dumps(results, indent=2))
+
+if baseline:
+    with open(baseline) as f:
+        old = json.load(f)
+    print("\n".join(compare(old, results)), file=sys.stderr)
@@ -0,0 +1,182 @@
+"""
+Timings of each transform, transform choice, iteration, tone mapping and
+saving, as rates that can be compared between versions and interpreters
+"""
+import os, platform, random, subprocess, tempfile, time
+import compiled, numpy, transforms
+from baseforms import MoebiusBase, SphericalBase, transform_choices
+from ifs import IFS, IFSI
+from image import Image
+from randomstream import RandomStream
+
+
+# Seeds of systems that render without degenerating, for the iteration timings
+ITERATE_SEEDS = (1, 2, 3)
+
+
+def best_time(fn, repeat, setup=None):
+    """
+    Shortest of repeat runs of fn, in seconds. Given setup, each run is
+    fn(setup()), with setup left out of the time.
+    """
+    best = float("inf")
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(seconds, count, unit):
+    return {"seconds": seconds, "count": count, "unit": unit, "per_second": count / seconds}
+
+
+def transform_variants(rng):
+    """
+    Each transform class on its own and inside each of the base forms
+    """
+    for cls in transform_choices():
+        yield cls(rng)
+        yield MoebiusBase(rng, cls(rng))
+        yield SphericalBase(rng, cls(rng))
+
+
+def bench_transforms(scale, repeat):
+    results = {}
+    rng = random.Random(0)
+    nprng = numpy.random.default_rng(0)
+    n = int(20000 * scale)
+    px, py = nprng.uniform(-1, 1, (2, n))
+    points = list(zip(px.tolist(), py.tolist()))
+
+    for t in transform_variants(rng):
+        # made with random.Random so they stay the same, but drawing from a
+        # RandomStream as they do when rendering
+        t.set_rng(RandomStream(0))
+        def scalar():
+            for x, y in points:
+                try:
+                    t.transform(x, y)
+                except ZeroDivisionError:
+                    pass
+        def array():
+            with numpy.errstate(all="ignore"):
+                t.transform_array(px, py, nprng)
+        name = "transform/" + t.get_name()
+        results[name + "/scalar"] = result(best_time(scalar, repeat), n, "points")
+        results[name + "/array"] = result(best_time(array, repeat), n, "points")
+    return results
+
+
+def bench_choose(scale, repeat):
+    results = {}
+    n = int(200000 * scale)
+    for num_transforms in (3, 100):
+        ifs = IFS(random.Random(0), num_transforms, 0.5, 0.5, [], [])
+        ifs.set_rng(RandomStream(0))
+        nprng = numpy.random.default_rng(0)
+        def scalar():
+            for i in range(n):
+                ifs.choose_transform()
+        def blocks():
+            for k in ifs.transform_choices(n, nprng):
+                pass
+        name = "choose/%d" % num_transforms
+        results[name + "/scalar"] = result(best_time(scalar, repeat), n, "choices")
+        results[name + "/blocks"] = result(best_time(blocks, repeat), n, "choices")
+        results[name + "/array"] = result(
+            best_time(lambda: ifs.choose_transforms(n, nprng), repeat), n, "choices")
+    return results
+
+
+def bench_iterate(scale, repeat):
+    results = {}
+    engines = [("python", 100, 100), ("numpy", 10000, 100)]
+    if compiled.AVAILABLE:
+        engines.append(("numba", 10000, 100))
+    for engine, points, iterations in engines:
+        points = max(1, int(points * scale))
+        for seed in ITERATE_SEEDS:
+            # a fresh IFSI for each run, made outside the timing, and a
+            # small render first so numba compiles its kernel untimed
+            setup = lambda: IFSI(500, 500, iterations, points, 3, 0.5, 0.5, seed)
+            IFSI(16, 16, 2, 2, 3, 0.5, 0.5, seed).render(bar=False, engine=engine)
+            render = lambda ifsi: ifsi.render(bar=False, engine=engine)
+            name = "iterate/%s/%d" % (engine, seed)
+            results[name] = result(best_time(render, repeat, setup), points * iterations, "point iterations")
+    return results
+
+
+def bench_image(scale, repeat):
+    results = {}
+    size = max(1, int(1000 * scale ** 0.5))
+    im = Image(size, size, 10)
+    im.view()[...] = numpy.random.default_rng(0).exponential(20, (size, size, 3))
+    pixels = size * size
+    results["image/calculate_scalefactor"] = result(
+        best_time(im.calculate_scalefactor, repeat), pixels, "pixels")
+    results["image/metrics"] = result(best_time(im.metrics, repeat), pixels, "pixels")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.png")
+        for bit_depth in (8, 16):
+            results["image/save/%d" % bit_depth] = result(
+                best_time(lambda: im.save(filename, bit_depth), repeat), pixels, "pixels")
+    return results
+
+
+BENCHMARKS = (
+    ("transform", bench_transforms),
+    ("choose", bench_choose),
+    ("iterate", bench_iterate),
+    ("image", bench_image),
+)
+
+
+def environment():
+    """
+    What the benchmarks ran on, so that runs can be compared fairly
+    """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                  text=True, cwd=os.path.dirname(os.path.abspath(transforms.__file__))).stdout.strip()
+    except OSError:
+        revision = ""
+    return {
+        "implementation": platform.python_implementation(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "revision": revision,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(only=(), scale=1.0, repeat=3, log=None):
+    """
+    Run the benchmark groups named in only, or all of them, with workloads
+    multiplied by scale. Returns the environment and the results by name.
+    """
+    results = {}
+    for group, bench in BENCHMARKS:
+        if only and group not in only:
+            continue
+        if log:
+            log("Running " + group + " benchmarks")
+        results.update(bench(scale, repeat))
+    return {"environment": environment(), "scale": scale, "results": results}
+
+
+def compare(old, new):
+    """
+    Lines comparing the rates of two runs, as new / old
+    """
+    lines = []
+    if old.get("scale") != new.get("scale"):
+        lines.append("Warning: runs used different scales")
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        before = old["results"][name]["per_second"]
+        after = new["results"][name]["per_second"]
+        lines.append("%-45s %14.0f %14.0f %7.2fx" % (name, before, after, after / before))
+    return lines
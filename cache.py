@@ -0,0 +1,72 @@
+"""
+Content-addressed cache of rendered image buffers, so rendering a known
+flame again, or tone mapping it differently, doesn't redo the sampling
+"""
+import hashlib, json, numpy, os
+from image import atomic_savez, Image
+
+
+# Factors larger than the image that a cached render can be scaled down by
+CACHE_DOWNSAMPLE_FACTORS = (2, 4, 8)
+
+
+class RenderCache:
+    """
+    Rendered image buffers kept in a directory, each in a file named by a
+    hash of everything that went into it: the IFS itself, the buffer size,
+    the points, iterations and seed, and the render options
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, ifsi, width, height, options):
+        """
+        Hash of everything that makes up the render of ifsi into a buffer
+        of the given size
+        """
+        params = dict(ifsi.parameters(), ifs=ifsi.ifs.parameters(), width=width, height=height,
+                      options=options)
+        for name in ("filename", "oversample", "num_transforms", "moebius_chance",
+                     "spherical_chance", "exclude", "include"):
+            # these don't change the buffer, or are already in the IFS
+            del params[name]
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npz")
+
+    def load(self, ifsi, options):
+        """
+        Fill the buffer of ifsi from the cache, if it has this render or one
+        at a whole multiple of the size to scale down, returning whether it
+        did. Scaled down renders differ in where the points that fall off
+        the canvas wrap around to.
+        """
+        for factor in (1,) + CACHE_DOWNSAMPLE_FACTORS:
+            path = self.path(self.key(ifsi, ifsi.im.width * factor, ifsi.im.height * factor, options))
+            if not os.path.exists(path):
+                continue
+            with numpy.load(path) as f:
+                meta = json.loads(str(f["meta"]))
+                if factor == 1:
+                    ifsi.im.view()[...] = f["data"]
+                else:
+                    im = Image(ifsi.im.width * factor, ifsi.im.height * factor, 1)
+                    im.view()[...] = f["data"]
+                    ifsi.im.view()[...] = im.downsample(factor).view()
+            ifsi.steps = meta["steps"]
+            ifsi.passes = meta["passes"]
+            ifsi.noise = meta["noise"]
+            ifsi.update_image_iterations()
+            return True
+        return False
+
+    def store(self, ifsi, options):
+        """
+        Save the buffer of ifsi to the cache
+        """
+        path = self.path(self.key(ifsi, ifsi.im.width, ifsi.im.height, options))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {"steps": ifsi.steps, "passes": ifsi.passes, "noise": ifsi.noise}
+        atomic_savez(path, meta=json.dumps(meta), data=ifsi.im.view())
+        return path
@@ -0,0 +1,288 @@
+"""
+Optional compiled render engine, using Numba.
+
+The transforms of an IFS are flattened into a table of numbers, one row per
+transform, and a single nopython kernel runs the whole chaos game from it:
+choosing transforms, applying them with their Moebius and spherical base
+forms, blending colours, the final transform and plotting. Without Numba
+installed, AVAILABLE is False and IFSI.render falls back to the numpy engine.
+
+Each transform class the kernel knows is registered in KERNELS with its kind
+number and a function giving its parameters. The kernel has a branch for
+each kind, so a new transform needs both a register call and a branch in
+apply_kind; transforms that aren't registered can't be compiled.
+"""
+import math
+import numpy
+import transforms
+from baseforms import MoebiusBase, SphericalBase
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+AVAILABLE = njit is not None
+
+# columns of a row of the parameter table
+KIND, MOEBIUS, SPHERICAL = 0, 1, 2
+MOEBIUS_COEFS = 3
+PARAMS = 11
+MAX_PARAMS = 8
+COLOUR = PARAMS + MAX_PARAMS
+INVERSE_COEFS = COLOUR + 3
+ROW_LENGTH = INVERSE_COEFS + 8
+
+# transform class: (kind number in the kernel, function giving its parameters)
+KERNELS = {}
+
+
+def register(cls, kind, params=None):
+    """
+    Register a transform class as kind number kind of the kernel. params
+    gives the list of up to MAX_PARAMS numbers for a transform of the class.
+    """
+    KERNELS[cls] = (kind, params or (lambda t: []))
+
+
+def complex_params(*coefs):
+    params = []
+    for z in coefs:
+        params += [z.real, z.imag]
+    return params
+
+
+register(transforms.Linear, 0, lambda t: [t.coef_a, t.coef_b, t.coef_c, t.coef_d])
+register(transforms.Moebius, 1, lambda t: complex_params(t.coef_a, t.coef_b, t.coef_c, t.coef_d))
+register(transforms.InverseJulia, 2, lambda t: complex_params(t.c))
+register(transforms.Bubble, 3)
+register(transforms.Sinusoidal, 4)
+register(transforms.Spherical, 5)
+register(transforms.Horseshoe, 6)
+register(transforms.Polar, 7)
+register(transforms.Handkerchief, 8)
+register(transforms.Heart, 9)
+register(transforms.Disc, 10)
+register(transforms.Spiral, 11)
+register(transforms.Hyperbolic, 12)
+register(transforms.Diamond, 13)
+register(transforms.Ex, 14)
+register(transforms.Swirl, 15)
+
+
+def supports(ifs):
+    """
+    Whether every transform of an IFS can be flattened into the table
+    """
+    try:
+        parameter_table(ifs)
+    except KeyError:
+        return False
+    return True
+
+
+def parameter_table(ifs):
+    """
+    Flatten the transforms of an IFS into a numpy array with one row per
+    transform. Raises KeyError for a transform class that isn't registered.
+    """
+    table = numpy.zeros((len(ifs.transforms), ROW_LENGTH))
+    for k, (weight, t) in enumerate(ifs.transforms):
+        row = table[k]
+        # the colour is whichever transform's transform_colour is used
+        owner = t.transform_colour.__self__
+        row[COLOUR:COLOUR + 3] = owner.r, owner.g, owner.b
+        if isinstance(t, SphericalBase):
+            row[SPHERICAL] = 1
+            t = t.xform
+        if isinstance(t, MoebiusBase):
+            row[MOEBIUS] = 1
+            row[MOEBIUS_COEFS:PARAMS] = complex_params(t.coef_a, t.coef_b, t.coef_c, t.coef_d)
+            # (dz-b)/(-cz+a) undoes it
+            row[INVERSE_COEFS:ROW_LENGTH] = complex_params(t.coef_d, -t.coef_b, -t.coef_c, t.coef_a)
+            t = t.xform
+        kind, params = KERNELS[type(t)]
+        params = params(t)
+        row[KIND] = kind
+        row[PARAMS:PARAMS + len(params)] = params
+    return table
+
+
+def moebius(m, px, py):
+    """
+    (az+b)/(cz+d) for z = px + i py, with the coefficients a, b, c, d as
+    pairs of real and imaginary parts in m, worked out in real arithmetic
+    """
+    nr = m[0] * px - m[1] * py + m[2]
+    ni = m[0] * py + m[1] * px + m[3]
+    dr = m[4] * px - m[5] * py + m[6]
+    di = m[4] * py + m[5] * px + m[7]
+    inv = 1.0 / (dr * dr + di * di)
+    return (nr * dr + ni * di) * inv, (ni * dr - nr * di) * inv
+
+
+def apply_kind(row, px, py):
+    """
+    Apply the transform of one row of the table, without its base forms
+    """
+    kind = int(row[KIND])
+    p = row[PARAMS:]
+    if kind == 0:
+        return p[0] * px + p[1] * py, p[2] * px + p[3] * py
+    if kind == 1:
+        return moebius(p, px, py)
+    if kind == 2:
+        z2 = complex(p[0], p[1]) - complex(px, py)
+        theta = math.atan2(z2.imag, z2.real) * 0.5
+        sqrt_r = (z2.imag * z2.imag + z2.real * z2.real) ** 0.25
+        if numpy.random.random() < 0.5:
+            sqrt_r = -sqrt_r
+        return sqrt_r * math.cos(theta), sqrt_r * math.sin(theta)
+    if kind == 3:
+        r2 = 4 / (px**2 + py**2 + 4)
+        return r2*px, r2*py
+    if kind == 4:
+        return math.sin(px), math.sin(py)
+    if kind == 5:
+        r2 = px**2 + py**2
+        return px/r2, py/r2
+    if kind == 15:
+        r2 = px**2 + py**2
+        return px*math.sin(r2) - py*math.cos(r2), px*math.cos(r2) + py*math.sin(r2)
+
+    # the rest are functions of polar coordinates, theta = atan(px/py)
+    r = math.sqrt(px**2 + py**2)
+    if kind == 6:
+        return (px-py)*(px+py)/r, 2*px*py/r
+    if kind == 7 or kind == 9 or kind == 10:
+        theta = math.atan(px/py)
+        if kind == 7:
+            return theta/math.pi, r-1
+        if kind == 9:
+            return r * math.sin(theta*r), -r * math.cos(theta*r)
+        thpi = theta/math.pi
+        return thpi * math.sin(math.pi*r), thpi * math.cos(math.pi*r)
+
+    # the others only need the sine and cosine of theta, which come from
+    # px, py and r without any trigonometry, the same up to rounding,
+    # and sums with r by the angle addition formulas
+    inv_r = 1.0 / r
+    sin_t = px * math.copysign(inv_r, py)
+    cos_t = abs(py) * inv_r
+    if kind == 11:
+        return (cos_t+math.sin(r))*inv_r, (sin_t-math.cos(r))*inv_r
+    if kind == 12:
+        return sin_t*inv_r, r * cos_t
+    sin_r, cos_r = math.sin(r), math.cos(r)
+    if kind == 13:
+        return sin_t*cos_r, cos_t*sin_r
+    sin_plus = sin_t*cos_r + cos_t*sin_r
+    cos_minus = cos_t*cos_r + sin_t*sin_r
+    if kind == 8:
+        return r * sin_plus, r * cos_minus
+    p03 = sin_plus**3
+    p13 = cos_minus**3
+    return r * (p03 + p13), r * (p03 - p13)
+
+
+def apply(row, px, py):
+    """
+    Apply the transform of one row of the table, with its base forms
+    """
+    if row[SPHERICAL]:
+        inv = 1.0 / (px**2 + py**2)
+        px, py = px*inv, py*inv
+    if row[MOEBIUS]:
+        px, py = moebius(row[MOEBIUS_COEFS:PARAMS], px, py)
+        px, py = apply_kind(row, px, py)
+        px, py = moebius(row[INVERSE_COEFS:ROW_LENGTH], px, py)
+    else:
+        px, py = apply_kind(row, px, py)
+    if row[SPHERICAL]:
+        inv = 1.0 / (px**2 + py**2)
+        px, py = px*inv, py*inv
+    return px, py
+
+
+def chaos_game(table, prob, alias, final, seed, num_points, iterations, burn_in, reseed,
+               width, height, data, failures=20):
+    """
+    Run num_points points through the system for iterations steps each,
+    adding their radiance to data, the flat image buffer, after the first
+    burn_in steps. Points that hit a singularity stay where they were, as
+    in the numpy engine, or with reseed start again from a new random
+    point, and False is returned if one does so failures times in a row.
+    """
+    numpy.random.seed(seed)
+    n = len(table)
+    size = width * height
+    a, b, c, d = complex(final[0]), complex(final[1]), complex(final[2]), complex(final[3])
+    # without the cz term it's a real scale and shift, needing no division
+    affine = final[2] == 0
+    scale, shift = final[0] / final[3], final[1] / final[3]
+    for i in range(num_points):
+        # Start with a random point, and the color black
+        px = numpy.random.uniform(-1, 1)
+        py = numpy.random.uniform(-1, 1)
+        r, g, bl = 0.0, 0.0, 0.0
+        zero_count = 0
+        skip = burn_in
+
+        for j in range(iterations):
+            # Choose a transform by weight with the alias table
+            u = numpy.random.random() * n
+            k = int(u)
+            if u - k >= prob[k]:
+                k = alias[k]
+            row = table[k]
+
+            nx, ny = apply(row, px, py)
+            r = (row[COLOUR] + r) / 2.0
+            g = (row[COLOUR + 1] + g) / 2.0
+            bl = (row[COLOUR + 2] + bl) / 2.0
+            burning = skip > 0
+            if burning:
+                skip -= 1
+            if not (math.isfinite(nx) and math.isfinite(ny)):
+                zero_count += 1
+                if zero_count >= failures:
+                    # Degenerate form. Abort render.
+                    return False
+                if reseed:
+                    px = numpy.random.uniform(-1, 1)
+                    py = numpy.random.uniform(-1, 1)
+                    r, g, bl = 0.0, 0.0, 0.0
+                    skip = burn_in
+                continue
+            px, py = nx, ny
+            zero_count = 0
+            if burning:
+                continue
+
+            # Apply final transform, and plot the point in the image buffer
+            if affine:
+                fx, fy = px * scale + shift, py * scale
+            else:
+                z = complex(px, py)
+                z = (a * z + b) / (c * z + d)
+                fx, fy = z.real, z.imag
+            x = (fx + 1) * width / 2
+            y = (fy + 1) * height / 2
+            if not (abs(x) < 2.0**62 and abs(y) < 2.0**62):
+                continue
+            index = int(x) + (height - 1 - int(y)) * width
+            if not 0 <= index < size:
+                # off the canvas, wrapping around as the other engines do
+                index %= size
+            index *= 3
+            data[index] += r
+            data[index + 1] += g
+            data[index + 2] += bl
+    return True
+
+
+if AVAILABLE:
+    moebius = njit(error_model="numpy", cache=True, inline="always")(moebius)
+    apply_kind = njit(error_model="numpy", cache=True, inline="always")(apply_kind)
+    apply = njit(error_model="numpy", cache=True, inline="always")(apply)
+    chaos_game = njit(error_model="numpy", cache=True)(chaos_game)
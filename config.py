@@ -2,6 +2,27 @@ width = 1000
 height = 1000
 iterations = 10000
 num_points = 10000
+burn_in = 0
+reseed = False
+oversample = 1
+previews = 0
+blur = 0
+hdr = False
+preview_size = 200
+preview_iterations = 1000
+preview_points = 2000
 num_transforms = 3
 moebius_chance = 0.5
 spherical_chance = 0.5
+workers = 1
+engine = None  # numba if it is installed and can do the render, else numpy
+passes = 1
+tolerance = None
+time_limit = None
+dataset_dir = "data"
+dataset = [("training", 500), ("validation", 50)]
+search_workers = 1
+render_workers = 1
+batch_seed = None
+stats_log = None
+cache_dir = None
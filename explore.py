@@ -0,0 +1,309 @@
+"""
+Exploration of many random systems as thumbnails, for picking favourites.
+
+Thumbnails are rendered in bulk from seeds, for every combination of swept
+values of num_transforms, moebius_chance and spherical_chance, without the
+seed search. Each is recorded in a SQLite index with its image metrics and
+the parameters of its IFS, so the index can be sorted and filtered by
+interest factor, entropy and so on, and the best promoted to full renders.
+Thumbnails already in the index are skipped, so an interrupted exploration
+carries on when run again. For example
+
+    python3 explore.py run -o explore -c 1000 --transforms 2,3,4 --moebius 0,0.5,1
+    python3 explore.py list -o explore --order interest_factor --min entropy=0.5
+    python3 explore.py promote -o explore -w 2000 -h 2000 17 42
+"""
+import getopt, itertools, json, multiprocessing, os, random, sqlite3, sys, time
+from batch import REPORT_INTERVAL, StageProgress
+from ifs import check_parameters, IFSI
+
+
+# Width and height of thumbnails, and their samples
+THUMBNAIL_SIZE = 128
+THUMBNAIL_ITERATIONS = 200
+THUMBNAIL_POINTS = 2000
+
+# Columns of the index measuring each thumbnail, from Image.metrics
+METRICS = ("interest_factor", "black_ratio", "colour_ratio", "coverage", "entropy", "dimension")
+
+# Columns the index can be sorted and filtered by
+COLUMNS = ("id", "seed", "num_transforms", "moebius_chance", "spherical_chance", "seconds") + METRICS
+
+
+def explore_jobs(directory, seeds, num_transforms=(3,), moebius_chance=(0.5,), spherical_chance=(0.5,),
+                 size=THUMBNAIL_SIZE, iterations=THUMBNAIL_ITERATIONS, num_points=THUMBNAIL_POINTS):
+    """
+    One thumbnail job for each seed and each combination of the swept
+    values. The same seed gives related systems for different values, as
+    they're made from the same random numbers.
+    """
+    jobs = []
+    for seed, n, m, s in itertools.product(seeds, num_transforms, moebius_chance, spherical_chance):
+        jobs.append({
+            "seed": seed, "num_transforms": n, "moebius_chance": m, "spherical_chance": s,
+            "size": size, "iterations": iterations, "num_points": num_points,
+            "filename": os.path.join(directory, "thumbnails", "%d_%d_%g_%g.png" % (seed, n, m, s)),
+        })
+    return jobs
+
+
+def thumbnail_job(job):
+    """
+    Render and save a thumbnail, returning the job with its name, IFS
+    parameters and metrics, or with degenerate set if it had a singular
+    transform or its render was degenerate
+    """
+    start = time.time()
+    args = (job["num_transforms"], job["moebius_chance"], job["spherical_chance"], job["seed"])
+    ifsi = IFSI(job["size"], job["size"], job["iterations"], job["num_points"], *args,
+                filename=job["filename"])
+    job = dict(job, name=ifsi.name, parameters=json.dumps(ifsi.ifs.parameters()), degenerate=True)
+    if check_parameters(*args) and ifsi.render(bar=False):
+        ifsi.save_image()
+        job.update(ifsi.im.metrics(), degenerate=False)
+    job["seconds"] = time.time() - start
+    return job
+
+
+class ThumbnailIndex:
+    """
+    SQLite index of explored thumbnails, one row per seed and swept values,
+    with its metrics (NULL for degenerate systems), the parameters of its
+    IFS as JSON, and the filename of its full render once promoted
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS thumbnails (
+                id INTEGER PRIMARY KEY,
+                seed INTEGER, num_transforms INTEGER, moebius_chance REAL, spherical_chance REAL,
+                name TEXT, filename TEXT, degenerate INTEGER, seconds REAL,
+                %s,
+                parameters TEXT, promoted TEXT,
+                UNIQUE (seed, num_transforms, moebius_chance, spherical_chance))
+            """ % ", ".join(name + " REAL" for name in METRICS))
+        self.db.execute("CREATE INDEX IF NOT EXISTS by_interest ON thumbnails (interest_factor)")
+        self.db.commit()
+
+    def __contains__(self, job):
+        return self.db.execute(
+            "SELECT 1 FROM thumbnails WHERE seed = ? AND num_transforms = ? AND moebius_chance = ? "
+            "AND spherical_chance = ?",
+            (job["seed"], job["num_transforms"], job["moebius_chance"], job["spherical_chance"])
+        ).fetchone() is not None
+
+    def add(self, job):
+        names = ["seed", "num_transforms", "moebius_chance", "spherical_chance", "name", "filename",
+                 "degenerate", "seconds", "parameters"] + [m for m in METRICS if m in job]
+        self.db.execute("INSERT OR REPLACE INTO thumbnails (%s) VALUES (%s)"
+                        % (", ".join(names), ", ".join("?" * len(names))),
+                        [job[name] for name in names])
+
+    def commit(self):
+        self.db.commit()
+
+    def query(self, order="interest_factor", descending=True, limit=None, degenerate=False,
+              promoted=None, **minimums):
+        """
+        Rows of the index sorted by a column of COLUMNS, with each column
+        given as a keyword at least that value. Degenerate systems are left
+        out unless degenerate is set, and given promoted, only those that
+        have or haven't been promoted are included.
+        """
+        where, values = [], []
+        for name, value in minimums.items():
+            if name not in COLUMNS:
+                raise ValueError("Unknown column: " + name)
+            where.append(name + " >= ?")
+            values.append(value)
+        if not degenerate:
+            where.append("NOT degenerate")
+        if promoted is not None:
+            where.append("promoted IS NOT NULL" if promoted else "promoted IS NULL")
+        if order not in COLUMNS:
+            raise ValueError("Unknown column: " + order)
+        sql = "SELECT * FROM thumbnails"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY %s %s" % (order, "DESC" if descending else "ASC")
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        return self.db.execute(sql, values).fetchall()
+
+    def get(self, id):
+        return self.db.execute("SELECT * FROM thumbnails WHERE id = ?", (id,)).fetchone()
+
+    def promote(self, id, directory, width, height, iterations, num_points, burn_in=0, reseed=False,
+                oversample=1, bar=True, save=None, **options):
+        """
+        Render the system of a row at full size from its saved parameters,
+        with its image and parameters file in directory, and record its
+        filename in the index. Any options are passed on to IFSI.render,
+        and save to IFSI.save_image. Returns the IFSI, or False if it was
+        degenerate.
+        """
+        row = self.get(id)
+        if row is None:
+            raise ValueError("No thumbnail with id %d" % id)
+        ifsi = IFSI(width, height, iterations, num_points, row["num_transforms"], row["moebius_chance"],
+                    row["spherical_chance"], row["seed"], burn_in=burn_in, reseed=reseed,
+                    oversample=oversample, ifs=json.loads(row["parameters"]))
+        ifsi.filename = os.path.join(directory, os.path.basename(ifsi.filename))
+        if not ifsi.render(bar=bar, **options):
+            return False
+        ifsi.save_image(**(save or {}))
+        ifsi.save_parameters()
+        self.db.execute("UPDATE thumbnails SET promoted = ? WHERE id = ?", (ifsi.filename, id))
+        self.db.commit()
+        return ifsi
+
+
+def explore(jobs, index, workers=1):
+    """
+    Render the thumbnails of the jobs that aren't in the index yet on a pool
+    of worker processes, adding each to the index as it finishes
+    """
+    todo = [job for job in jobs if job not in index]
+    print("%d of %d thumbnails already explored" % (len(jobs) - len(todo), len(jobs)))
+    progress = StageProgress("explore", len(todo))
+    last_report = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        for job in pool.imap_unordered(thumbnail_job, todo):
+            index.add(job)
+            progress.update(job["seconds"])
+            if time.time() - last_report >= REPORT_INTERVAL or progress.done == progress.total:
+                index.commit()
+                print(progress.report())
+                last_report = time.time()
+    index.commit()
+
+
+def print_help():
+    print("""
+    Usage: explore.py run|list|promote [options] [ID ...]
+
+    -?, --help: Display this list
+    -o, --output: Directory for the index, thumbnails and promoted renders (default: explore)
+
+    run: render thumbnails into the index
+    -c, --count: Number of random seeds, each rendered with every combination of swept values
+    --seeds: Comma separated seeds to use instead of random ones
+    --explore-seed: Seed for reproducibly random seeds
+    --transforms: Comma separated values of num_transforms to sweep
+    --moebius: Comma separated values of moebius_chance to sweep
+    --spherical: Comma separated values of spherical_chance to sweep
+    -s, --size: Width and height of the thumbnails (default: %d)
+    -j, --workers: Number of processes rendering thumbnails
+
+    list: print the index, best first
+    --order: Column to sort by, one of %s (default: interest_factor)
+    --ascending: Sort lowest first
+    --min: Smallest value of a column, as column=value; may be repeated
+    -n, --limit: Most rows to print (default: 20)
+
+    promote: render the thumbnails with the given IDs at full size
+    -w, --width, -h, --height: Size of the full render (default: from config.py)
+    --engine, --passes, --oversample: As for pyifs.py
+    """ % (THUMBNAIL_SIZE, ", ".join(COLUMNS)))
+
+
+def numbers(arg, kind):
+    return [kind(value) for value in arg.split(",")]
+
+
+if __name__ == "__main__":
+    import config
+
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else None
+        opts, args = getopt.getopt(sys.argv[2:], "?o:c:s:j:n:w:h:",
+                     ["help","output=","count=","seeds=","explore-seed=","transforms=","moebius=",
+                      "spherical=","size=","workers=","order=","ascending","min=","limit=","width=",
+                      "height=","engine=","passes=","oversample="])
+        if command not in ("run", "list", "promote"):
+            raise getopt.error("Unknown command: " + str(command))
+    except getopt.error as msg:
+        sys.stdout = sys.stderr
+        print(msg)
+        print_help()
+        sys.exit(2)
+
+    directory, count, seeds, explore_seed = "explore", 100, None, None
+    sweep = {"num_transforms": [config.num_transforms], "moebius_chance": [config.moebius_chance],
+             "spherical_chance": [config.spherical_chance]}
+    size, workers = THUMBNAIL_SIZE, 1
+    order, descending, minimums, limit = "interest_factor", True, {}, 20
+    width, height, render = config.width, config.height, {"engine": config.engine, "passes": config.passes}
+    ifsi_options = {"burn_in": config.burn_in, "reseed": config.reseed, "oversample": config.oversample}
+    for opt, arg in opts:
+        if opt in ["-?","--help"]:
+            print_help()
+            sys.exit(0)
+        if opt in ["-o","--output"]:
+            directory = arg
+        if opt in ["-c","--count"]:
+            count = int(arg)
+        if opt in ["--seeds"]:
+            seeds = numbers(arg, int)
+        if opt in ["--explore-seed"]:
+            explore_seed = int(arg)
+        if opt in ["--transforms"]:
+            sweep["num_transforms"] = numbers(arg, int)
+        if opt in ["--moebius"]:
+            sweep["moebius_chance"] = numbers(arg, float)
+        if opt in ["--spherical"]:
+            sweep["spherical_chance"] = numbers(arg, float)
+        if opt in ["-s","--size"]:
+            size = int(arg)
+        if opt in ["-j","--workers"]:
+            workers = int(arg)
+        if opt in ["--order"]:
+            order = arg
+        if opt in ["--ascending"]:
+            descending = False
+        if opt in ["--min"]:
+            name, value = arg.split("=", 1)
+            minimums[name] = float(value)
+        if opt in ["-n","--limit"]:
+            limit = int(arg)
+        if opt in ["-w","--width"]:
+            width = int(arg)
+        if opt in ["-h","--height"]:
+            height = int(arg)
+        if opt in ["--engine"]:
+            render["engine"] = arg
+        if opt in ["--passes"]:
+            render["passes"] = int(arg)
+        if opt in ["--oversample"]:
+            ifsi_options["oversample"] = int(arg)
+
+    index = ThumbnailIndex(os.path.join(directory, "index.sqlite"))
+    if command == "run":
+        if seeds is None:
+            rng = random.Random(explore_seed)
+            seeds = [rng.randrange(sys.maxsize) for i in range(count)]
+        explore(explore_jobs(directory, seeds, size=size, **sweep), index, workers)
+
+    elif command == "list":
+        try:
+            rows = index.query(order, descending, limit, **minimums)
+        except ValueError as msg:
+            print(msg, file=sys.stderr)
+            sys.exit(2)
+        print("%6s %20s %3s %5s %5s %8s %7s %9s %8s  %s" % ("id", "seed", "n", "moeb", "sphr", "interest",
+                                                          "entropy", "dimension", "coverage", "image"))
+        for row in rows:
+            print("%6d %20d %3d %5.2f %5.2f %8.1f %7.3f %9.3f %8.3f  %s" % (
+                row["id"], row["seed"], row["num_transforms"], row["moebius_chance"], row["spherical_chance"],
+                row["interest_factor"], row["entropy"], row["dimension"], row["coverage"],
+                row["promoted"] or row["filename"]))
+
+    else:
+        for id in args:
+            ifsi = index.promote(int(id), os.path.join(directory, "promoted"), width, height,
+                                 config.iterations, config.num_points, **ifsi_options, **render)
+            print(ifsi.filename if ifsi else "Thumbnail %s was degenerate at full size" % id)
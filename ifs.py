@@ -1,111 +1,1012 @@
-import inspect, numpy, os, random, sys, transforms
-from baseforms import MoebiusBase, SphericalBase
-from click import progressbar
-from image import Image
-from math import log10, isnan
+import contextlib, functools, hashlib, itertools, json, multiprocessing, numpy, os, random, sys, time, transforms, warnings
+from baseforms import MoebiusBase, SphericalBase, TRANSFORMS, transform_choices
+from cache import RenderCache
+from image import atomic_savez, Image, PNG_COMPRESSION_LEVEL, PNG_COMPRESSION_STRATEGY
+from randomstream import BLOCK_SIZE, generator, RandomStream
+from math import isfinite, isinf, isnan, nan
 
 
-def safelog10(x):
-    try:
-        return log10(x)
-    except ValueError:
-        return 0.0
+# Number of hits buffered by IFSI.iterate_array before adding them to the image
+ARRAY_HITS_BUFFER = 2 ** 20
 
-def test_seed(num_transforms, moebius_chance, spherical_chance, seed):
+# Seconds between checkpoints saved by IFSI.iterate_array
+CHECKPOINT_INTERVAL = 60.0
+
+# Points run by each call of the compiled kernel in IFSI.iterate_compiled
+COMPILED_CHUNK_POINTS = 1000
+
+# Longest name of the transforms in a default filename. Past it the name is
+# cut short and ends in a hash of the whole name instead, keeping it unique
+# within the 255 bytes most filesystems allow a filename
+FILENAME_MAX_NAME = 120
+
+# Coefficients a, b, c, d of the final Moebius transform (az+b)/(cz+d)
+FINAL_TRANSFORM = (0.5, 0, 0, 1)
+
+# A system is degenerate, and its render aborted, once any point has hit a
+# singularity this many times in a row, or more than this fraction of the
+# points, and at least DEGENERATE_FAILURES of them, hit one at the same
+# iteration, so that a few long lived walkers aren't judged on one step
+DEGENERATE_FAILURES = 20
+DEGENERATE_FRACTION = 0.5
+
+# Stages of test_seed, and the limits used by each. The coarse stage's
+# interest limit is set below the lowest coarse interest factor of seeds
+# passing the full stage, so it rejects only seeds the full one would.
+SEED_STAGES = ("parameters", "coarse", "full")
+SEED_MIN_DETERMINANT = 1e-9
+SEED_COARSE_SIZE = 75
+SEED_COARSE_POINTS = 500
+SEED_COARSE_ITERATIONS = 60
+SEED_COARSE_MIN_INTEREST = 150
+SEED_FULL_SIZE = 150
+SEED_FULL_POINTS = 1000
+SEED_FULL_ITERATIONS = 1000
+SEED_MIN_INTEREST = 120
+SEED_MIN_ENTROPY = 0.5
+SEED_MIN_DIMENSION = 1.4
+
+# Candidate seeds given to each worker at a time by get_seed
+SEED_BATCH = 4
+
+
+class SeedStats:
+    """
+    Counts and timings for each stage of test_seed, to show where the seed
+    search spends its time
+    """
+    def __init__(self):
+        self.tested = dict.fromkeys(SEED_STAGES, 0)
+        self.passed = dict.fromkeys(SEED_STAGES, 0)
+        self.seconds = dict.fromkeys(SEED_STAGES, 0.0)
+
+    def record(self, stage, passed, seconds):
+        self.tested[stage] += 1
+        self.passed[stage] += bool(passed)
+        self.seconds[stage] += seconds
+
+    def merge(self, other):
+        for stage in SEED_STAGES:
+            self.tested[stage] += other.tested[stage]
+            self.passed[stage] += other.passed[stage]
+            self.seconds[stage] += other.seconds[stage]
+        return self
+
+    def report(self):
+        lines = []
+        for stage in SEED_STAGES:
+            tested = self.tested[stage]
+            if tested:
+                lines.append("%-10s %7d tested %6.1f%% passed %9.2f ms each %9.2f s total" % (
+                    stage, tested, 100.0 * self.passed[stage] / tested,
+                    1000 * self.seconds[stage] / tested, self.seconds[stage]))
+        return "\n".join(lines)
+
+
+class RenderStats:
+    """
+    Optional instrumentation of an IFSI render: calls, time and numerical
+    trouble for each transform, how many samples land off the canvas (and
+    so wrap around), and the time spent in each stage
+    """
+    def __init__(self):
+        self.transforms = []
+        self.samples = 0
+        self.off_canvas = 0
+        self.stages = {}
+
+    def set_transforms(self, names):
+        if not self.transforms:
+            self.transforms = [{"name": name, "calls": 0, "seconds": 0.0, "nan": 0,
+                                "divergence": 0, "zero_division": 0} for name in names]
+
+    def record_transform(self, k, seconds, calls=1, nan=0, divergence=0, zero_division=0):
+        """
+        Add calls of transform number k, and how many of them gave NaN, went
+        to infinity, or raised at a singularity, such as the complex
+        division of a Moebius transform by zero. The numpy engine never
+        raises, so those show up there as NaN or infinity.
+        """
+        t = self.transforms[k]
+        t["calls"] += calls
+        t["seconds"] += seconds
+        t["nan"] += nan
+        t["divergence"] += divergence
+        t["zero_division"] += zero_division
+
+    def record_transform_array(self, k, seconds, points):
+        nan = numpy.isnan(points).any(axis=0)
+        divergence = numpy.isinf(points).any(axis=0) & ~nan
+        self.record_transform(k, seconds, points.shape[1], int(nan.sum()), int(divergence.sum()))
+
+    def record_hits(self, samples, off_canvas):
+        self.samples += int(samples)
+        self.off_canvas += int(off_canvas)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed code as part of the named stage
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other):
+        self.set_transforms([t["name"] for t in other.transforms])
+        for t, o in zip(self.transforms, other.transforms):
+            for key in ("calls", "seconds", "nan", "divergence", "zero_division"):
+                t[key] += o[key]
+        self.record_hits(other.samples, other.off_canvas)
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        return self
+
+    def off_canvas_fraction(self):
+        return self.off_canvas / self.samples if self.samples else 0.0
+
+    def as_dict(self):
+        return {"transforms": self.transforms, "samples": self.samples,
+                "off_canvas": self.off_canvas, "off_canvas_fraction": self.off_canvas_fraction(),
+                "stages": self.stages}
+
+    def report(self):
+        lines = []
+        for t in self.transforms:
+            each = 1e9 * t["seconds"] / t["calls"] if t["calls"] else 0.0
+            lines.append("%-24s %12d calls %9.1f ns each %9d NaN %9d diverged %9d zero division" % (
+                t["name"], t["calls"], each, t["nan"], t["divergence"], t["zero_division"]))
+        lines.append("%.2f%% of %d samples off the canvas" % (100 * self.off_canvas_fraction(), self.samples))
+        for name, seconds in self.stages.items():
+            lines.append("%-24s %9.2f s" % (name, seconds))
+        return "\n".join(lines)
+
+    def log(self, path, **extra):
+        """
+        Append the stats, and any extra fields, to a JSON lines log file
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps(dict(extra, **self.as_dict())) + "\n")
+
+
+def check_parameters(num_transforms, moebius_chance, spherical_chance, seed):
+    """
+    Reject systems with a singular transform, which maps the whole plane onto
+    a line or a single point
+    """
+    ifs = IFSI(1, 1, 1, 1, num_transforms, moebius_chance, spherical_chance, seed).ifs
+    for weight, t in ifs.transforms:
+        while t is not None:
+            if hasattr(t, "coef_a"):
+                if abs(t.coef_a * t.coef_d - t.coef_b * t.coef_c) < SEED_MIN_DETERMINANT:
+                    return False
+            t = getattr(t, "xform", None)
+    return True
+
+
+def check_coarse(num_transforms, moebius_chance, spherical_chance, seed):
+    """
+    Reject systems that are degenerate, or that are clearly too plain, from
+    a small sparse render. Its radiance is scaled up to the hits per pixel
+    of the full stage's render, so that its interest factor, which depends
+    on how bright the pixels are, estimates that of the full render.
+    """
+    coarse = IFSI(SEED_COARSE_SIZE, SEED_COARSE_SIZE, SEED_COARSE_ITERATIONS, SEED_COARSE_POINTS,
+                  num_transforms, moebius_chance, spherical_chance, seed)
+    if not coarse.iterate_array(range(coarse.iterations)):
+        return False
+    full_hits = SEED_FULL_POINTS * SEED_FULL_ITERATIONS / float(SEED_FULL_SIZE**2)
+    coarse_hits = SEED_COARSE_POINTS * SEED_COARSE_ITERATIONS / float(SEED_COARSE_SIZE**2)
+    coarse.im.view()[...] *= full_hits / coarse_hits
+    metrics = coarse.im.metrics()
+    return (metrics["interest_factor"] >= SEED_COARSE_MIN_INTEREST
+            and metrics["entropy"] >= SEED_MIN_ENTROPY)
+
+
+def check_full(num_transforms, moebius_chance, spherical_chance, seed):
     """
     Test whether the IFS seed will be both non-degenerate and interesting by
-    rendering a low-resolution version
+    rendering a low-resolution version. Besides the interest factor, its
+    radiance mustn't be concentrated in a few pixels, and it mustn't be
+    little more than a curve or a few points.
     """
-    lowres = IFSI(150, 150, 1000, 1000, num_transforms, moebius_chance, spherical_chance, seed)
-    if lowres.iterate(range(1000)):
-        if lowres.im.interest_factor() >= 120:
-            return True
+    lowres = IFSI(SEED_FULL_SIZE, SEED_FULL_SIZE, SEED_FULL_ITERATIONS, SEED_FULL_POINTS,
+                  num_transforms, moebius_chance, spherical_chance, seed)
+    if lowres.iterate_array(range(lowres.iterations)):
+        metrics = lowres.im.metrics()
+        return (metrics["interest_factor"] >= SEED_MIN_INTEREST
+                and metrics["entropy"] >= SEED_MIN_ENTROPY
+                and metrics["dimension"] >= SEED_MIN_DIMENSION)
     return False
 
 
-def get_seed(num_transforms, moebius_chance, spherical_chance):
-    while True:
-        seed = random.randrange(sys.maxsize)
-        if test_seed(num_transforms, moebius_chance, spherical_chance, seed):
-            return seed
+def test_seed(num_transforms, moebius_chance, spherical_chance, seed, stats=None):
+    """
+    Run the seed through each stage of checks in turn, cheapest first, so
+    that most bad seeds are rejected before the full low-resolution render
+    """
+    for stage, check in zip(SEED_STAGES, (check_parameters, check_coarse, check_full)):
+        start = time.perf_counter()
+        passed = check(num_transforms, moebius_chance, spherical_chance, seed)
+        if stats is not None:
+            stats.record(stage, passed, time.perf_counter() - start)
+        if not passed:
+            return False
+    return True
+
+
+def test_seed_job(job):
+    """
+    test_seed for a worker process, returning the seed, result and stats
+    """
+    stats = SeedStats()
+    return job[-1], test_seed(*job, stats=stats), stats
+
+
+def get_seed(num_transforms, moebius_chance, spherical_chance, workers=1, stats=None, rng=random):
+    """
+    Draw random seeds from rng until one passes test_seed. With more than one
+    worker, candidates are tested in parallel batches and the first passing
+    seed of each batch is used.
+    """
+    if workers <= 1:
+        while True:
+            seed = rng.randrange(sys.maxsize)
+            if test_seed(num_transforms, moebius_chance, spherical_chance, seed, stats):
+                return seed
+
+    with multiprocessing.Pool(workers) as pool:
+        while True:
+            jobs = [(num_transforms, moebius_chance, spherical_chance, rng.randrange(sys.maxsize))
+                    for i in range(workers * SEED_BATCH)]
+            results = pool.map(test_seed_job, jobs, chunksize=SEED_BATCH)
+            if stats is not None:
+                for seed, passed, part in results:
+                    stats.merge(part)
+            for seed, passed, part in results:
+                if passed:
+                    return seed
+
+
+def render_part(job):
+    """
+    Render one worker's share of the points of an IFSI with its own random
+    stream, returning its image and stats for merging, or False if
+    degenerate. The IFSI is recreated from its parameters, so only those
+    are sent to the worker, not the IFSI with its transforms and image.
+    """
+    params, buffer_dtype, keep_stats, stream, engine, passes = job
+    # Count only this share, and leave timing the stages to the parent
+    ifsi = IFSI(buffer_dtype=buffer_dtype, stats=RenderStats() if keep_stats else None, **params)
+    ifsi.set_stream(stream)
+    if ifsi.render(bar=False, engine=engine, passes=passes):
+        if ifsi.stats is not None:
+            ifsi.stats.stages = {}
+        return ifsi.im, ifsi.stats
+    return False
+
+
+def load_checkpoint(path):
+    """
+    Recreate the IFSI saved in a checkpoint file, with its image and points
+    as they were, so that render can carry on from there
+    """
+    with numpy.load(path) as f:
+        meta = json.loads(str(f["meta"]))
+    ifsi = IFSI(meta["width"], meta["height"], meta["iterations"], meta["num_points"],
+                meta["num_transforms"], meta["moebius_chance"], meta["spherical_chance"],
+                meta["seed"], meta["exclude"], meta["include"], meta["filename"],
+                burn_in=meta["burn_in"], reseed=meta["reseed"], oversample=meta["oversample"],
+                ifs=meta["ifs"])
+    return ifsi.load_checkpoint(path)
+
+
+def load_parameters(path, **changes):
+    """
+    Recreate the IFSI saved by IFSI.save_parameters, with any of its
+    arguments changed, for example to render it at another size. Unless a
+    filename is given, it gets the default one for its size, so it doesn't
+    overwrite the image it came from.
+    """
+    with open(path) as f:
+        params = json.load(f)["parameters"]
+    # older files saved the filename too
+    params.pop("filename", None)
+    params.update(changes)
+    return IFSI(**params)
+
+
+def load_transform(params, rng):
+    """
+    Recreate a transform, and any transform it wraps, from its parameters
+    """
+    cls = {"MoebiusBase": MoebiusBase, "SphericalBase": SphericalBase}.get(params["class"])
+    if cls is None:
+        cls = TRANSFORMS[params["class"]]
+    t = cls.__new__(cls)
+    t.rng = rng
+    t.set_parameters(params, lambda p: load_transform(p, rng))
+    return t
+
+
+def image_change(before, after):
+    """
+    RMS difference between two tone-mapped images, relative to the RMS of
+    the later one, as an estimate of the noise left in it
+    """
+    scale = numpy.sqrt(numpy.mean(numpy.square(after)))
+    if scale == 0:
+        return float("inf")
+    return float(numpy.sqrt(numpy.mean(numpy.square(after - before))) / scale)
+
+
+def alias_table(weights):
+    """
+    Build the probability and alias lists for Vose's alias method, so that
+    choosing by weight takes one random number and one comparison
+    """
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    prob, alias = [1.0] * n, list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] += scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
 
 
 class IFSI: # IFS Image
-    def __init__(self, width, height, iterations, num_points, num_transforms, moebius_chance, spherical_chance, seed, exclude=[], include=[], filename=None):
+    def __init__(self, width, height, iterations, num_points, num_transforms, moebius_chance, spherical_chance, seed, exclude=[], include=[], filename=None, buffer_dtype=numpy.float64, buffer_path=None, stats=None, burn_in=0, reseed=False, oversample=1, ifs=None):
+        """
+        Each of the num_points points is run through the system for
+        iterations steps, of which the first burn_in, while it falls onto
+        the attractor, aren't plotted. Points that hit a singularity stay
+        where they were, or with reseed start again from a new random point,
+        burn-in and all, which suits a few points with very long orbits.
+
+        The hits are plotted into an image buffer oversample times the width
+        and height, which is scaled down to the final image when saved.
+
+        Given ifs, the parameters saved by IFS.parameters, that IFS is used
+        instead of the one the seed makes, which still seeds the points.
+
+        The seed makes the IFS with random.Random, as it always has, so a
+        seed keeps making the same IFS. The render itself draws from a
+        RandomStream of the seed, which the IFS and its transforms share.
+        """
         self.seed = seed
-        self.rng = random.Random(seed)
-        self.ifs = IFS(self.rng, num_transforms, moebius_chance, spherical_chance, exclude, include)
-        self.im = Image(width, height, max(1, (num_points * iterations) / (width * height)))
+        rng = random.Random(seed)
+        self.ifs = IFS(rng, num_transforms, moebius_chance, spherical_chance, exclude, include)
+        self.ifs_parameters = ifs
+        if ifs is not None:
+            self.ifs = IFS.from_parameters(ifs, rng)
+        pixels = width * height * oversample * oversample
+        self.im = Image(width * oversample, height * oversample,
+                        max(1, (num_points * max(1, iterations - burn_in)) / pixels),
+                        buffer_dtype, buffer_path)
+        self.width = width
+        self.height = height
+        self.oversample = oversample
         self.iterations = iterations
         self.num_points = num_points
+        self.num_transforms = num_transforms
+        self.moebius_chance = moebius_chance
+        self.spherical_chance = spherical_chance
+        self.exclude = list(exclude)
+        self.include = list(include)
+        self.burn_in = burn_in
+        self.reseed = reseed
+        self.set_stream(seed)
+        self.passes = 1
+        self.steps = 0
+        self.walkers = None
+        self.start = None
+        self.noise = []
         self.name = "-".join([t.get_name() for w,t in self.ifs.transforms])
+        self.stats = stats
+        if stats is not None:
+            stats.set_transforms([t.get_name() for w,t in self.ifs.transforms])
         if filename == None:
-            self.filename = os.path.join("im", self.name + "_" + str(self.seed))
-            self.filename += "_" + str(self.im.width) + "x" + str(self.im.height)
+            name = self.name
+            if len(name) > FILENAME_MAX_NAME:
+                digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:10]
+                name = name[:FILENAME_MAX_NAME - len(digest) - 1] + "-" + digest
+            self.filename = os.path.join("im", name + "_" + str(self.seed))
+            self.filename += "_" + str(self.width) + "x" + str(self.height)
             self.filename += ".png"
         else:
             self.filename = filename
 
-    def render(self, bar=True):
-        if bar is True:
-            label = "Rendering " + self.name
-            with progressbar(length=self.num_points, label=label, width=0) as iter:
-                if self.iterate(iter):
-                    return self
+    def parameters(self):
+        """
+        The arguments that recreate this IFSI
+        """
+        return {"width": self.width, "height": self.height,
+                "iterations": self.iterations, "num_points": self.num_points,
+                "num_transforms": self.num_transforms, "moebius_chance": self.moebius_chance,
+                "spherical_chance": self.spherical_chance, "seed": self.seed,
+                "exclude": self.exclude, "include": self.include, "filename": self.filename,
+                "burn_in": self.burn_in, "reseed": self.reseed, "oversample": self.oversample,
+                "ifs": self.ifs_parameters}
+
+    def default_engine(self, passes=1, checkpoint=None, adaptive=False):
+        """
+        The fastest engine that can do a render: numba, if it's installed
+        and can compile the system, unless the render needs the numpy
+        engine for more than one pass, a checkpoint, adaptive sampling,
+        stats, points carrying on from start_from or a resumed render
+        """
+        if (passes != 1 or checkpoint is not None or adaptive or self.stats is not None
+                or self.start is not None or self.steps):
+            return "numpy"
+        import compiled
+        if compiled.AVAILABLE and compiled.supports(self.ifs):
+            return "numba"
+        return "numpy"
+
+    def render(self, bar=True, engine=None, workers=1, passes=1, checkpoint=None, resume=None,
+               tolerance=None, time_limit=None, cache=None):
+        """
+        Render the image with either the "numpy" engine, which moves all points
+        together one iteration at a time, the original "python" engine,
+        which moves one point at a time and is best run under PyPy, or the
+        "numba" engine, which runs the python engine's loop compiled and
+        falls back to numpy if Numba isn't installed, or if stats are being
+        kept, which the compiled loop doesn't record. By default, the
+        fastest engine that can do the render is used, as default_engine
+        picks it. With more than one worker the points are split between
+        processes.
+
+        Each pass runs the points through the system again from new random
+        starting points, so more passes give a less noisy image. The numpy
+        engine can save its progress to a checkpoint file, and resume from
+        one, including adding more passes to a finished render.
+
+        Given a tolerance or a time limit in seconds, the numpy engine renders
+        adaptively: after each pass it measures how much the tone-mapped
+        image changed, and stops early once the change is within tolerance,
+        or before a pass that would go over the time limit. Then passes is
+        only the most that will be run, and self.noise holds the change
+        after each pass.
+
+        Given a RenderCache, or the directory of one, a render it already
+        has with the same IFS and options is loaded from it instead, and a
+        new render is stored in it. Renders with a time limit, or resumed
+        from a checkpoint, aren't cached, as they can't be repeated exactly.
+        """
+        if resume is not None:
+            self.load_checkpoint(resume)
+            if checkpoint is None:
+                checkpoint = resume
+        self.passes = passes
+
+        adaptive = tolerance is not None or time_limit is not None
+        if engine is None:
+            engine = self.default_engine(passes, checkpoint, adaptive)
+        if engine == "numba":
+            # Numba takes a while to import, so only when it's wanted
+            import compiled
+        if engine == "numba" and not compiled.AVAILABLE:
+            warnings.warn("Numba isn't installed, rendering with the numpy engine")
+            engine = "numpy"
+        elif engine == "numba" and not compiled.supports(self.ifs):
+            warnings.warn("Can't compile " + self.name + ", rendering with the numpy engine")
+            engine = "numpy"
+        elif engine == "numba" and self.stats is not None:
+            warnings.warn("The numba engine doesn't keep stats, rendering with the numpy engine")
+            engine = "numpy"
+
+        if engine == "numpy":
+            if adaptive:
+                iterate = functools.partial(self.iterate_adaptive, checkpoint=checkpoint,
+                                            tolerance=tolerance, time_limit=time_limit)
+            else:
+                iterate = functools.partial(self.iterate_array, checkpoint=checkpoint)
+            steps = range(self.steps, self.iterations * passes)
+        elif engine in ("python", "numba"):
+            if passes != 1 or checkpoint is not None or adaptive:
+                raise ValueError("Passes, checkpoints and adaptive renders need the numpy engine")
+            if engine == "python":
+                iterate, steps = self.iterate, range(self.num_points)
+            else:
+                iterate = self.iterate_compiled
+                steps = range(0, self.num_points, COMPILED_CHUNK_POINTS)
         else:
-            if hasattr(bar, "UpdateBar"):
-                guibar = bar
+            raise ValueError("Unknown render engine: " + str(engine))
+        workers = min(workers, self.num_points)
+        if workers > 1:
+            if checkpoint is not None or adaptive:
+                raise ValueError("Checkpoints and adaptive renders need a single worker")
+            iterate = functools.partial(self.iterate_parallel, workers=workers, engine=engine, passes=passes)
+            steps = range(workers)
+
+        if cache is not None and (time_limit is not None or self.steps):
+            cache = None
+        if cache is not None:
+            if not isinstance(cache, RenderCache):
+                cache = RenderCache(cache)
+            options = {"engine": engine, "workers": workers, "passes": passes, "tolerance": tolerance}
+            with self.stage("cache"):
+                if cache.load(self, options):
+                    return self
+
+        with self.stage("iterate"):
+            if bar is True:
+                from click import progressbar
+                label = "Rendering " + self.name
+                with progressbar(steps, label=label, width=0) as iter:
+                    result = iterate(iter)
             else:
-                guibar = None
-            if self.iterate(range(self.num_points), guibar=guibar):
-                return self
-        return False
+                if hasattr(bar, "UpdateBar"):
+                    guibar = bar
+                else:
+                    guibar = None
+                result = iterate(steps, guibar=guibar)
+        if not result:
+            return False
+        if cache is not None:
+            with self.stage("cache"):
+                cache.store(self, options)
+        return self
+
+    def stage(self, name):
+        """
+        Context manager timing a stage of the render, if stats are being kept
+        """
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.stage(name)
+
+    def iterate_parallel(self, iterator, workers, engine="numpy", passes=1, guibar=None):
+        """
+        Split the points between a pool of worker processes, one per step of
+        the iterator. Each worker has its own random stream, split off this
+        IFSI's, and image buffer, and the buffers are merged in order, so the
+        result only depends on the stream and the number of workers.
+        """
+        streams = self.rng.spawn(workers)
+        counts = [self.num_points // workers + (i < self.num_points % workers) for i in range(workers)]
+        params = dict(self.parameters(), ifs=self.ifs.parameters())
+        jobs = [(dict(params, num_points=count), self.im.view().dtype, self.stats is not None, stream, engine, passes)
+                for stream, count in zip(streams, counts)]
+        with multiprocessing.Pool(workers) as pool:
+            for i, part in zip(iterator, pool.imap(render_part, jobs)):
+                if part is False:
+                    # Degenerate form. Abort render.
+                    return False
+                im, stats = part
+                self.im.merge(im)
+                if self.stats is not None:
+                    self.stats.merge(stats)
+                if guibar:
+                    guibar.UpdateBar(i+1, workers)
+        self.steps = self.iterations * passes
+        self.update_image_iterations()
+        return self
 
     def iterate(self, iterator, guibar=None):
+        """
+        Run the points through the system one at a time. As in the other
+        engines, a point that the transform takes to NaN or infinity, or
+        that it raises at, stays where it was, or with reseed starts again
+        from a new random point, and isn't plotted. A point doing so
+        DEGENERATE_FAILURES times in a row aborts the render as degenerate.
+        """
+        stats = self.stats
+        transforms = [t for w, t in self.ifs.transforms]
         for i in iterator:
 
             # Start with a random point, and the color black
             px = self.rng.uniform(-1, 1)
             py = self.rng.uniform(-1, 1)
             r, g, b = 0.0, 0.0, 0.0
-            zero_count, cont_count = 0, 0
+            zero_count = 0
+            skip = self.burn_in
 
             # Run the starting point through the system repeatedly
-            for j in range(self.iterations):
-                t = self.ifs.choose_transform()
+            for k in self.ifs.transform_choices(self.iterations, self.rng.generator):
+                t = transforms[k]
+                raised = False
+                if stats is not None:
+                    start = time.perf_counter()
                 try:
-                    px, py = t.transform(px, py)
-                except ZeroDivisionError:
-                    zero_count += 1
-                    if zero_count >= 10:
-                        cont_count +=1
-                        if cont_count >= 10:
-                            # Degenerate form. Abort render.
-                            return False
-                        continue
+                    nx, ny = t.transform(px, py)
+                except (ArithmeticError, ValueError):
+                    # Python raises at some singularities rather than giving
+                    # NaN or infinity, such as dividing a complex number by 0
+                    nx, ny, raised = nan, nan, True
+                if stats is not None:
+                    stats.record_transform(k, time.perf_counter() - start, nan=not raised and (isnan(nx) or isnan(ny)),
+                                           divergence=isinf(nx) or isinf(ny), zero_division=raised)
                 r, g, b = t.transform_colour(r, g, b)
+                burning = skip > 0
+                if burning:
+                    skip -= 1
+                if not (isfinite(nx) and isfinite(ny)):
+                    zero_count += 1
+                    if zero_count >= DEGENERATE_FAILURES:
+                        # Degenerate form. Abort render.
+                        return False
+                    if self.reseed:
+                        # Start again from a new random point
+                        px = self.rng.uniform(-1, 1)
+                        py = self.rng.uniform(-1, 1)
+                        r, g, b = 0.0, 0.0, 0.0
+                        skip = self.burn_in
+                    continue
+                px, py = nx, ny
+                zero_count = 0
+                if burning:
+                    # Still burning in, so don't plot
+                    continue
 
                 # Apply final transform for every iteration
                 fx, fy = self.ifs.final_transform(px, py)
-                x = int((fx + 1) * self.im.width / 2)
-                y = int((fy + 1) * self.im.height / 2)
+                x = (fx + 1) * self.im.width / 2
+                y = (fy + 1) * self.im.height / 2
+                if not (abs(x) < 2.0**62 and abs(y) < 2.0**62):
+                    # Too far off the canvas to wrap around to it
+                    continue
+                x, y = int(x), int(y)
 
                 # Plot the point in the image buffer
                 self.im.add_radiance(x, y, [r, g, b])
+                if stats is not None:
+                    stats.record_hits(1, not (0 <= x < self.im.width and 0 <= y < self.im.height))
 
             if guibar:
-                guibar.UpdateBar(i+1)
+                guibar.UpdateBar(i+1, self.num_points)
+        self.steps = self.iterations
+        return self
+
+    def iterate_compiled(self, iterator, guibar=None):
+        """
+        Run the points through the system with the compiled kernel, in
+        chunks of COMPILED_CHUNK_POINTS, one per step of the iterator, each
+        with its own seed drawn from the stream.
+        """
+        import compiled
+        table = compiled.parameter_table(self.ifs)
+        final = numpy.array(FINAL_TRANSFORM, dtype=float)
+        data = self.im.view().reshape(-1)
+        chunks = -(-self.num_points // COMPILED_CHUNK_POINTS)
+        seeds = generator(self.stream).integers(2**32, size=chunks)
+        for start, seed in zip(iterator, seeds):
+            count = min(COMPILED_CHUNK_POINTS, self.num_points - start)
+            if not compiled.chaos_game(table, self.ifs.alias_prob_array, self.ifs.alias_array,
+                                       final, seed, count, self.iterations, self.burn_in,
+                                       self.reseed, self.im.width, self.im.height, data,
+                                       DEGENERATE_FAILURES):
+                # Degenerate form. Abort render.
+                return False
+            if guibar:
+                guibar.UpdateBar(start + count, self.num_points)
+        self.steps = self.iterations
+        self.update_image_iterations()
+        return self
+
+    def iterate_adaptive(self, iterator, guibar=None, checkpoint=None, tolerance=None, time_limit=None):
+        """
+        Run iterate_array one pass at a time, taking the steps of each pass
+        from the iterator, until the tone-mapped image changes by no more
+        than tolerance over a pass, or another pass, taking as long as the
+        last, would go over time_limit seconds.
+        """
+        start = time.time()
+        iterator = iter(iterator)
+        before = self.im.display_array() if self.steps else None
+        self.noise = []
+        while self.steps < self.iterations * self.passes:
+            pass_start = time.time()
+            end = (self.steps // self.iterations + 1) * self.iterations
+            if not self.iterate_array(itertools.islice(iterator, end - self.steps), guibar, checkpoint):
+                return False
+
+            with self.stage("convergence"):
+                after = self.im.display_array()
+                if before is not None:
+                    self.noise.append(image_change(before, after))
+                    if tolerance is not None and self.noise[-1] <= tolerance:
+                        break
+                before = after
+            now = time.time()
+            if time_limit is not None and now + (now - pass_start) - start > time_limit:
+                break
+        self.passes = -(-self.steps // self.iterations)
         return self
 
-    def save_image(self):
-        if not os.path.exists("im"):
-            os.makedirs("im")
-        self.im.save(self.filename)
+    def iterate_array(self, iterator, guibar=None, checkpoint=None):
+        """
+        Run all of the points through the system together as numpy arrays.
+        Each step of the iterator is the number of the iteration to run next,
+        counting on through later passes, which start again from new random
+        points. If a checkpoint file is given, progress is saved to it every
+        CHECKPOINT_INTERVAL seconds and at the end.
+        """
+        n = self.num_points
+        stats = self.stats
+        new_points = numpy.empty((2, n))
+        if self.walkers is not None:
+            rng, points, colours, zero_count, skip = self.walkers
+        else:
+            rng, points, colours, zero_count, skip = None, None, None, None, None
+
+        # Hits are buffered for several iterations, then plotted together
+        rows = max(1, min(ARRAY_HITS_BUFFER // n, self.iterations))
+        hit_xy = numpy.zeros((2, rows, n), dtype=numpy.int64)
+        hit_colours = numpy.zeros((3, rows, n))
+        row = 0
+        last_checkpoint = time.time()
+
+        with numpy.errstate(all="ignore"):
+            for step in iterator:
+                if step % self.iterations == 0:
+                    # Start with random points, and the color black, or
+                    # where start_from says
+                    rng = generator(self.pass_stream(step // self.iterations))
+                    if step == 0 and self.start is not None:
+                        points, colours = (a.copy() for a in self.start)
+                    else:
+                        points = rng.uniform(-1, 1, (2, n))
+                        colours = numpy.zeros((3, n))
+                    zero_count = numpy.zeros(n, dtype=numpy.int64)
+                    skip = numpy.full(n, self.burn_in, dtype=numpy.int64)
+
+                # Group the points by chosen transform, with a radix sort
+                choices = self.ifs.choose_transforms(n, rng)
+                order = numpy.argsort(choices.astype(numpy.int16), kind="stable")
+                counts = numpy.bincount(choices, minlength=len(self.ifs.transforms))
+                ends = numpy.cumsum(counts)
+                for k, (weight, t) in enumerate(self.ifs.transforms):
+                    idx = order[ends[k] - counts[k]:ends[k]]
+                    if len(idx) == 0:
+                        continue
+                    start = time.perf_counter()
+                    new_points[:, idx] = t.transform_array(*points[:, idx], rng)
+                    if stats is not None:
+                        stats.record_transform_array(k, time.perf_counter() - start, new_points[:, idx])
+                    colours[:, idx] = t.transform_colour(*colours[:, idx])
+
+                # Points still burning in aren't plotted
+                if self.burn_in:
+                    burning = skip > 0
+                    skip -= burning
+
+                # Points that hit a singularity stay where they were, as they
+                # do in iterate, or start again
+                ok = numpy.isfinite(new_points).all(axis=0)
+                if not ok.all():
+                    # Count each point's failures in a row, so that a long
+                    # lived walker failing now and then isn't degenerate
+                    zero_count += ~ok
+                    zero_count *= ~ok
+                    failures = n - numpy.count_nonzero(ok)
+                    if (zero_count.max() >= DEGENERATE_FAILURES
+                            or failures >= max(DEGENERATE_FAILURES, DEGENERATE_FRACTION * n)):
+                        # Degenerate form. Abort render.
+                        return False
+                    if self.reseed:
+                        failed = numpy.flatnonzero(~ok)
+                        new_points[:, failed] = rng.uniform(-1, 1, (2, len(failed)))
+                        colours[:, failed] = 0
+                        skip[failed] = self.burn_in
+                    else:
+                        numpy.copyto(new_points, points, where=~ok)
+                elif zero_count.any():
+                    zero_count.fill(0)
+                points, new_points = new_points, points
+                if self.burn_in:
+                    ok &= ~burning
+
+                # Apply final transform for every iteration
+                fx, fy = self.ifs.final_transform(*points)
+                x = (fx + 1) * self.im.width / 2
+                y = (fy + 1) * self.im.height / 2
+
+                # Buffer the hits, with no radiance for points that can't be plotted
+                ok &= (numpy.abs(x) < 2**62) & (numpy.abs(y) < 2**62)
+                if stats is not None:
+                    on_canvas = (x >= 0) & (x < self.im.width) & (y >= 0) & (y < self.im.height)
+                    stats.record_hits(ok.sum(), (ok & ~on_canvas).sum())
+                numpy.copyto(hit_xy[0, row], x, where=ok, casting="unsafe")
+                numpy.copyto(hit_xy[1, row], y, where=ok, casting="unsafe")
+                numpy.multiply(colours, ok, out=hit_colours[:, row])
+                row += 1
+                self.steps = step + 1
+
+                # Plot the buffered points in the image buffer, and save
+                # them with the points when a checkpoint is due
+                due = checkpoint is not None and time.time() - last_checkpoint >= CHECKPOINT_INTERVAL
+                if row == rows or due:
+                    self.im.add_radiance_array(*hit_xy[:, :row].reshape(2, -1),
+                                               *hit_colours[:, :row].reshape(3, -1))
+                    row = 0
+                if due:
+                    self.walkers = (rng, points, colours, zero_count, skip)
+                    self.save_checkpoint(checkpoint)
+                    last_checkpoint = time.time()
+
+                if guibar:
+                    guibar.UpdateBar(step+1, self.iterations * self.passes)
+
+        self.im.add_radiance_array(*hit_xy[:, :row].reshape(2, -1),
+                                   *hit_colours[:, :row].reshape(3, -1))
+
+        # Keep where the points ended up, for carrying on later
+        if points is not None:
+            self.walkers = (rng, points, colours, zero_count, skip)
+        self.update_image_iterations()
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
         return self
 
-    def get_image(self):
-        a = numpy.array([safelog10(x) for x in self.im.data])
-        return numpy.reshape(a / max(a), (self.im.width, self.im.height, 3))
+    def start_from(self, points, colours):
+        """
+        Start the first pass of the numpy engine from the given points and
+        colours, such as where the points of the last frame of an animation
+        ended up, instead of from random points and black. There must be
+        num_points of each.
+        """
+        self.start = (points, colours)
+
+    def set_stream(self, stream):
+        """
+        Draw the random numbers of the render from stream, a seed or a
+        SeedSequence, through a RandomStream shared with the IFS
+        """
+        self.stream = stream
+        self.rng = RandomStream(stream)
+        self.ifs.set_rng(self.rng)
+
+    def pass_stream(self, p):
+        """
+        Random stream for the starting points and choices of pass number p
+        """
+        if p == 0:
+            return self.stream
+        key = getattr(self.stream, "spawn_key", ())
+        return numpy.random.SeedSequence(self.seed, spawn_key=key + (p,))
+
+    def update_image_iterations(self):
+        """
+        Match the image's samples per pixel, which its tone mapping is
+        scaled by, to the iterations plotted so far
+        """
+        passes, steps = divmod(self.steps, self.iterations)
+        plotted = passes * max(0, self.iterations - self.burn_in) + max(0, steps - self.burn_in)
+        samples = self.num_points * plotted
+        self.im.iterations = max(1, samples / (self.im.width * self.im.height))
+
+    def save_checkpoint(self, path):
+        """
+        Save the image buffer, the number of iterations done, and the state
+        of the points partway through a pass to a compressed numpy file
+        """
+        self.update_image_iterations()
+        meta = dict(self.parameters(), name=self.name, steps=self.steps,
+                    samples=self.steps * self.num_points)
+        arrays = {"data": self.im.view()}
+        if self.walkers is not None and self.steps % self.iterations:
+            rng, points, colours, zero_count, skip = self.walkers
+            meta["rng"] = rng.bit_generator.state
+            arrays.update(points=points, colours=colours, zero_count=zero_count, skip=skip)
+        atomic_savez(path, meta=json.dumps(meta), **arrays)
+        return self
+
+    def load_checkpoint(self, path):
+        """
+        Load the image buffer and state of the points from a checkpoint file
+        saved by this same IFSI
+        """
+        with numpy.load(path) as f:
+            meta = json.loads(str(f["meta"]))
+            for key, value in self.parameters().items():
+                if key != "filename" and meta[key] != value:
+                    raise ValueError("Checkpoint " + path + " has a different " + key)
+            self.im.view()[...] = f["data"]
+            self.steps = meta["steps"]
+            self.walkers = None
+            if "rng" in meta:
+                rng = generator()
+                rng.bit_generator.state = meta["rng"]
+                self.walkers = (rng, f["points"], f["colours"], f["zero_count"], f["skip"])
+        self.update_image_iterations()
+        return self
+
+    def images(self, previews=0, blur=0):
+        """
+        The final image, scaled down from the oversampled buffer and
+        filtered by density estimation with radius up to blur if blur is
+        given, followed by previews images each half the size of the one
+        before. All of them come from the same hits.
+        """
+        with self.stage("downsample"):
+            im = self.im
+            if self.oversample > 1:
+                im = im.downsample(self.oversample)
+            if blur:
+                im = im.density_blur(blur)
+            return im.pyramid(previews)
+
+    def preview_filename(self, level):
+        """
+        Filename of the preview level times halved from the final image
+        """
+        root, ext = os.path.splitext(self.filename)
+        return root + "." + str(level) + ext
+
+    def save_parameters(self, path=None):
+        """
+        Save everything needed to render this image again to a JSON file,
+        by default next to the image, including the IFS itself: each
+        transform's class, coefficients, weight, colour and base forms,
+        but not the filename. load_parameters reads it back.
+        """
+        if path is None:
+            path = os.path.splitext(self.filename)[0] + ".json"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        params = dict(self.parameters(), ifs=self.ifs.parameters())
+        del params["filename"]
+        with open(path, "w") as f:
+            json.dump({"name": self.name, "parameters": params}, f, indent=1)
+        return path
+
+    def save_image(self, bit_depth=8, level=PNG_COMPRESSION_LEVEL, strategy=PNG_COMPRESSION_STRATEGY,
+                   previews=0, blur=0, hdr=False, **tone):
+        """
+        Save the image to self.filename, along with any smaller previews
+        made from the same hits, named by preview_filename. Any tone mapping
+        options are passed on to Image.display_blocks. With hdr, the raw
+        radiance of the final image, before blurring, is also saved as
+        hdr_filename, for tonemap.py to tone map again without rendering.
+        """
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        images = self.images(previews, blur)
+        with self.stage("save"):
+            for i, im in enumerate(images):
+                filename = self.preview_filename(i) if i else self.filename
+                im.save(filename, bit_depth, level, strategy, **tone)
+            if hdr:
+                im = self.im.downsample(self.oversample) if self.oversample > 1 else self.im
+                im.save_hdr(self.hdr_filename())
+        return self
+
+    def hdr_filename(self):
+        """
+        Filename of the raw radiance of the image saved with hdr
+        """
+        return os.path.splitext(self.filename)[0] + ".npz"
+
+    def get_image(self, max_size=None):
+        """
+        Log-scaled preview of the image rendered so far, as a float32 numpy
+        array shaped (height, width, 3) and scaled 0 - 1, cheap enough to
+        redraw while rendering. It takes every oversample-th pixel of the
+        buffer, or more widely spaced pixels so that it is at most max_size
+        across, without copying the buffer first.
+        """
+        step = self.oversample
+        if max_size is not None:
+            step = max(step, -(-max(self.im.width, self.im.height) // max_size))
+        a = numpy.add(self.im.view()[::step, ::step], 1, dtype=numpy.float32)
+        numpy.log10(a, out=a)
+        top = a.max()
+        if top > 0:
+            a /= top
+        return a
 
 class IFS:
     def __init__(self, rng, num_transforms, moebius_chance, spherical_chance, exclude, include):
@@ -113,47 +1014,89 @@ class IFS:
         self.total_weight = 0
         self.rng = rng
 
-        transform_choices = []
-        transform_list = inspect.getmembers(sys.modules["transforms"], inspect.isclass)
-        name_list = [name for (name, obj) in transform_list]
-        name_list = list(set(name_list) - set(exclude))
-
-        if include != []:
-            name_list = list(set(name_list) & set(include))
-        for (name, obj) in transform_list:
-            if name in name_list:
-                transform_choices.append(obj)
-
+        choices = transform_choices(exclude, include)
         for n in range(num_transforms):
             # Pick a transform, and possibly either a Moebius and/or Spherical baseform
-            xform = self.rng.choice(transform_choices)(self.rng)
+            xform = self.rng.choice(choices)(self.rng)
             if self.rng.random() < moebius_chance:
                 xform = MoebiusBase(self.rng, xform)
             if self.rng.random() < spherical_chance:
                 xform = SphericalBase(self.rng, xform)
             self.add_transform(xform)
 
-    def add_transform(self, transform):
-        weight = self.rng.gauss(1, 0.2) * self.rng.gauss(1, 0.2)
+    @classmethod
+    def from_parameters(cls, params, rng):
+        """
+        Recreate an IFS from the parameters it saved, with its transforms
+        using rng for any randomness
+        """
+        ifs = cls(rng, 0, 0, 0, [], [])
+        for t in params["transforms"]:
+            ifs.add_transform(load_transform(t["transform"], rng), t["weight"])
+        return ifs
+
+    def parameters(self):
+        """
+        The weight and parameters of each transform, as a dict that can be
+        saved as JSON
+        """
+        return {"transforms": [{"weight": w, "transform": t.parameters()} for w, t in self.transforms]}
+
+    def set_rng(self, rng):
+        """
+        Draw the random numbers for choosing transforms, and those the
+        transforms themselves use, from rng
+        """
+        self.rng = rng
+        for w, t in self.transforms:
+            t.set_rng(rng)
+
+    def add_transform(self, transform, weight=None):
+        if weight is None:
+            weight = self.rng.gauss(1, 0.2) * self.rng.gauss(1, 0.2)
         self.total_weight += weight
         self.transforms.append((weight, transform))
+        self.alias_prob, self.alias = alias_table([w for w, t in self.transforms])
+        self.alias_prob_array = numpy.array(self.alias_prob)
+        self.alias_array = numpy.array(self.alias)
 
     def choose_transform(self):
-        w = self.rng.random() * self.total_weight
-        running_total = 0
-        for weight, transform in self.transforms:
-            running_total += weight
-            if w <= running_total:
-                return transform
+        """
+        Choose a transform by weight in constant time, using the alias table
+        """
+        u = self.rng.random() * len(self.transforms)
+        i = int(u)
+        if u - i >= self.alias_prob[i]:
+            i = self.alias[i]
+        return self.transforms[i][1]
+
+    def choose_transforms(self, n, rng):
+        """
+        Choose n transforms at once using the numpy generator rng, returning
+        an array of indices into self.transforms
+        """
+        u = rng.random(n) * len(self.transforms)
+        i = u.astype(numpy.int64)
+        return numpy.where(u - i < self.alias_prob_array[i], i, self.alias_array[i])
+
+    def transform_choices(self, n, rng):
+        """
+        Iterate over the indices of n transforms chosen by weight, choosing
+        them a block at a time with the numpy generator rng
+        """
+        for start in range(0, n, BLOCK_SIZE):
+            yield from self.choose_transforms(min(BLOCK_SIZE, n - start), rng).tolist()
 
     def final_transform(self, px, py):
         """
-        Final transform to be applied after each iteration
+        Final transform to be applied after each iteration. Works on floats or
+        numpy arrays of points.
         """
-        a = 0.5
-        b = 0
-        c = 0
-        d = 1
-        z = complex(px, py)
+        a, b, c, d = FINAL_TRANSFORM
+        if c == 0 and not any(isinstance(k, complex) for k in FINAL_TRANSFORM):
+            # Just a real scale and shift, as the default is, so it needs no
+            # complex division
+            return px * (a / d) + b / d, py * (a / d)
+        z = px + 1j * py
         z2 = (a * z + b) / (c * z + d)
         return z2.real, z2.imag
@@ -1,6 +1,6 @@
 from array import array
-from math import log10
-from numpy import zeros
+import numpy
+import os
 import struct
 import zlib
 
@@ -10,23 +10,51 @@ RGB_LUMINANCE = (0.2126, 0.7152, 0.0722)
 
 DISPLAY_LUMINANCE_MAX = 200.0
 
-# formula from Ward "A Contrast-Based Scalefactor for Luminance Display"
-SCALEFACTOR_NUMERATOR = 1.219 + (DISPLAY_LUMINANCE_MAX * 0.25) ** 0.4
+GAMMA_ENCODE = 0.45
 
+# tone mapping operators: Ward's linear scalefactor, and Reinhard's global
+# operator, which compresses luminance L to L / (1 + L)
+TONE_OPERATORS = ("ward", "reinhard")
 
-GAMMA_ENCODE = 0.45
+# display luminance the Reinhard operator maps the log-mean luminance to
+REINHARD_KEY = 0.18
+
+# channel values below this count as black in the quality metrics
+BLACK_LEVEL = 10
+
+# pixels count towards the coverage and dimension metrics when their radiance
+# is above this fraction of the mean radiance of the pixels hit, so that the
+# sparse haze most attractors spread over the whole image doesn't fill them
+DENSE_FRACTION = 0.1
+
+# smallest number of boxes across for the fractal dimension estimate
+DIMENSION_MIN_BOXES = 8
+
+# zlib settings for PNG output
+PNG_COMPRESSION_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+PNG_COMPRESSION_STRATEGY = zlib.Z_DEFAULT_STRATEGY
+
+# pixels in each block of rows that tone mapping and saving work through
+ROW_BLOCK_PIXELS = 2 ** 20
 
 
 class Image(object):
 
-    def __init__(self, width, height, iterations):
+    def __init__(self, width, height, iterations, dtype=numpy.float64, path=None):
         """
-        initialize blank image.
+        initialize blank image. The buffer holds values of the given numpy
+        dtype; float32 halves its size. Given a path, the buffer is a
+        numpy.memmap of that file, so very large images needn't fit in memory.
         """
         self.width = width
         self.height = height
         self.iterations = iterations
-        self.data = array("d", [0]) * (width * height * 3)
+        if path is not None:
+            self.data = numpy.memmap(path, dtype=dtype, mode="w+", shape=(width * height * 3,))
+        elif numpy.dtype(dtype) != numpy.float64:
+            self.data = numpy.zeros(width * height * 3, dtype=dtype)
+        else:
+            self.data = array("d", [0]) * (width * height * 3)
 
     def _index(self, t):
         x, y, channel = t
@@ -48,83 +76,338 @@ class Image(object):
         self[x, y, 1] += radiance[1]
         self[x, y, 2] += radiance[2]
 
-    def calculate_scalefactor(self):
+    def view(self):
+        """
+        numpy view of the image buffer, shaped (height, width, 3) with the top
+        row first. Writes to the view go straight into the buffer.
+        """
+        if isinstance(self.data, numpy.ndarray):
+            data = self.data
+        else:
+            data = numpy.frombuffer(self.data, dtype=numpy.float64)
+        return data.reshape(self.height, self.width, 3)
+
+    def row_blocks(self):
+        """
+        iterate over views of blocks of whole rows, top row first, so large
+        images can be processed without copying all of them at once.
+        """
+        rows = max(1, ROW_BLOCK_PIXELS // self.width)
+        view = self.view()
+        for y in range(0, self.height, rows):
+            yield view[y:y + rows]
+
+    def add_radiance_array(self, x, y, r, g, b):
+        """
+        add radiance for numpy arrays of x, y positions and matching r, g, b
+        arrays. Positions outside the image wrap around exactly as in _index.
+        """
+        size = self.width * self.height
+        pixel = numpy.mod(x + (self.height - 1 - y) * self.width, size)
+        flat = self.view().reshape(size, 3)
+        if size <= 4 * len(pixel):
+            flat[:, 0] += numpy.bincount(pixel, weights=r, minlength=size)
+            flat[:, 1] += numpy.bincount(pixel, weights=g, minlength=size)
+            flat[:, 2] += numpy.bincount(pixel, weights=b, minlength=size)
+        elif len(pixel):
+            # sum the hits on each pixel hit, instead of counting over every
+            # pixel of a much larger image
+            order = numpy.argsort(pixel)
+            pixel = pixel[order]
+            starts = numpy.flatnonzero(numpy.concatenate(([True], pixel[1:] != pixel[:-1])))
+            pixel = pixel[starts]
+            flat[pixel, 0] += numpy.add.reduceat(r[order], starts)
+            flat[pixel, 1] += numpy.add.reduceat(g[order], starts)
+            flat[pixel, 2] += numpy.add.reduceat(b[order], starts)
+
+    def merge(self, other):
         """
-        calculate the linear tone-mapping scalefactor for this image
+        add the radiance of another image of the same size into this one.
         """
-        ## calculate the log-mean luminance of the image
+        if (other.width, other.height) != (self.width, self.height):
+            raise ValueError("can't merge images of different sizes")
+        self.view()[...] += other.view()
+        return self
 
+    def downsample(self, factor):
+        """
+        new image a factor smaller each way, each pixel of it the sum of a
+        factor x factor block of this one, so that it has the same total
+        radiance and factor**2 times the samples per pixel. Rows and columns
+        that don't make up a whole block are left out.
+        """
+        width, height = self.width // factor, self.height // factor
+        im = Image(width, height, self.iterations * factor * factor)
+        rows = max(1, ROW_BLOCK_PIXELS // (self.width * factor)) * factor
+        view, out = self.view(), im.view()
+        for y in range(0, height * factor, rows):
+            block = view[y:min(y + rows, height * factor), :width * factor]
+            out[y // factor:(y + len(block)) // factor] = block.reshape(
+                len(block) // factor, factor, width, factor, 3).sum(axis=(1, 3))
+        return im
+
+    def pyramid(self, levels):
+        """
+        list of this image followed by levels images, each half the size of
+        the one before, all made from the same hits
+        """
+        images = [self]
+        for i in range(levels):
+            images.append(images[-1].downsample(2))
+        return images
+
+    def density_blur(self, max_radius=4, curve=0.4):
+        """
+        new image filtered by density estimation: each pixel is averaged
+        over a square whose radius shrinks with the density of hits there,
+        as max_radius / density**curve, so sparse areas are smoothed and
+        dense detail is kept. Each integer radius is a separable box blur of
+        the whole image, done with cumulative sums.
+        """
+        view = self.view()
+        density = numpy.maximum(view.sum(axis=2), 1.0)
+        radius = numpy.rint(max_radius / density ** curve).astype(numpy.int64)
+        im = Image(self.width, self.height, self.iterations)
+        out = im.view()
+        out[...] = view
+        for r in range(1, max_radius + 1):
+            where = radius == r
+            if where.any():
+                out[where] = box_blur(view, r)[where]
+        return im
+
+    def log_mean_luminance(self):
+        """
+        calculate the log-mean luminance of the image
+        """
         sum_of_logs = 0.0
 
-        for x in range(self.width):
-            for y in range(self.height):
-                lum = self[x, y, 0] * RGB_LUMINANCE[0]
-                lum += self[x, y, 1] * RGB_LUMINANCE[1]
-                lum += self[x, y, 2] * RGB_LUMINANCE[2]
-                lum /= self.iterations
+        for rows in self.row_blocks():
+            lum = rows.dot(RGB_LUMINANCE) / self.iterations
+            sum_of_logs += numpy.log10(numpy.maximum(lum, 0.0001)).sum()
 
-                sum_of_logs += log10(max(lum, 0.0001))
+        return 10.0 ** (sum_of_logs / (self.height * self.width))
 
-        log_mean_luminance = 10.0 ** (sum_of_logs / (self.height * self.width))
+    def calculate_scalefactor(self, luminance_max=DISPLAY_LUMINANCE_MAX):
+        """
+        calculate the linear tone-mapping scalefactor for this image, shown
+        on a display of the given maximum luminance
+        """
+        log_mean_luminance = self.log_mean_luminance()
 
         ## calculate the scalefactor for linear tone-mapping
 
         # formula from Ward "A Contrast-Based Scalefactor for Luminance Display"
 
         scalefactor = (
-            (SCALEFACTOR_NUMERATOR / (1.219 + log_mean_luminance ** 0.4)) ** 2.5
-        ) / DISPLAY_LUMINANCE_MAX
+            ((1.219 + (luminance_max * 0.25) ** 0.4) / (1.219 + log_mean_luminance ** 0.4)) ** 2.5
+        ) / luminance_max
 
         return scalefactor
 
+    def display_blocks(self, operator="ward", exposure=1.0, gamma=GAMMA_ENCODE,
+                       luminance_max=DISPLAY_LUMINANCE_MAX):
+        """
+        iterate over blocks of rows of the gamma-corrected image, top row
+        first, as numpy arrays scaled 0 - 1 (although not clipped to 1).
+        The radiance is tone mapped by one of TONE_OPERATORS, multiplied by
+        exposure, then raised to the power gamma. luminance_max is the
+        maximum luminance of the display for the "ward" operator.
+        """
+        if operator == "ward":
+            scale = self.calculate_scalefactor(luminance_max) / self.iterations * exposure
+        elif operator == "reinhard":
+            scale = REINHARD_KEY / self.log_mean_luminance() / self.iterations * exposure
+        else:
+            raise ValueError("Unknown tone mapping operator: " + str(operator))
+        for rows in self.row_blocks():
+            a = rows * scale
+            if operator == "reinhard":
+                a /= 1 + numpy.maximum(a.dot(RGB_LUMINANCE), 0)[..., None]
+            numpy.maximum(a, 0, out=a)
+            yield numpy.power(a, gamma, out=a)
+
+    def display_array(self, **tone):
+        """
+        numpy array shaped (height, width, 3) of the gamma-corrected image,
+        scaled 0 - 1 (although not clipped to 1), tone mapped as in
+        display_blocks.
+        """
+        return numpy.concatenate(list(self.display_blocks(**tone)))
+
     def display_pixels(self):
         """
         iterate over each channel of each pixel in image returning
         gamma-corrected number scaled 0 - 1 (although not clipped to 1).
         """
-        scalefactor = self.calculate_scalefactor()
-
-        for value in self.data:
-            yield max(value * scalefactor / self.iterations, 0) ** GAMMA_ENCODE
+        return iter(self.display_array().ravel())
 
     def black_ratio(self):
         """
         ratio of total pixel count to black pixels, used for quality check
         """
-        return len(self.data) / float(len([i for i in self.data if i < 10]))
+        return self.metrics()["black_ratio"]
 
     def colour_ratio(self):
         """
         ratio of unique values to total value count, used for quality check
         """
-        return float(len(set([int(i) for i in self.data]))) / len(self.data)
+        return self.metrics()["colour_ratio"]
 
     def interest_factor(self):
         """
         combination of factors to check for potential visual appeal
         """
-        return self.black_ratio() * self.colour_ratio()**0.5 * 10e2
+        return self.metrics()["interest_factor"]
+
+    def metrics(self):
+        """
+        quality measures of the image, all worked out in one pass through
+        its blocks of rows:
+
+        black_ratio: total channel values over those below BLACK_LEVEL
+        colour_ratio: distinct integer channel values over total values
+        interest_factor: black_ratio * colour_ratio**0.5 * 1000
+        coverage: fraction of pixels dense, above DENSE_FRACTION of the mean
+            radiance of the pixels hit
+        entropy: Shannon entropy of the radiance of each pixel, scaled 0 - 1
+            from all of it in one pixel to all pixels equal
+        dimension: box-counting estimate of the fractal dimension of the
+            dense pixels, 0 for a point up to 2 for a filled area
+        """
+        black = 0
+        seen = numpy.zeros(1, dtype=bool)
+        values = []
+        total = 0.0
+        sum_s_log_s = 0.0
+        hits = 0
+        radiance = numpy.empty((self.height, self.width), dtype=numpy.float32)
+        y = 0
+        for rows in self.row_blocks():
+            black += numpy.count_nonzero(rows < BLACK_LEVEL)
+            ints = rows.astype(numpy.int64).ravel()
+            top = ints.max()
+            if ints.min() >= 0 and top < 4 * len(self.data):
+                # mark the values present in a table, rather than sorting
+                if top >= len(seen):
+                    seen = numpy.concatenate((seen, numpy.zeros(top + 1 - len(seen), dtype=bool)))
+                seen[ints] = True
+            else:
+                values.append(numpy.unique(ints))
+            s = rows.sum(axis=2, dtype=numpy.float64)
+            radiance[y:y + len(rows)] = s
+            s = s[s > 0]
+            hits += len(s)
+            total += s.sum()
+            sum_s_log_s += (s * numpy.log(s)).sum()
+            y += len(rows)
+
+        size = self.width * self.height
+        black_ratio = len(self.data) / float(max(1, black))
+        values.append(numpy.flatnonzero(seen))
+        colour_ratio = float(len(numpy.unique(numpy.concatenate(values)))) / len(self.data)
+        if total > 0 and size > 1:
+            entropy = (numpy.log(total) - sum_s_log_s / total) / numpy.log(size)
+        else:
+            entropy = 0.0
+        dense = radiance > DENSE_FRACTION * total / max(1, hits)
+        return {"black_ratio": black_ratio, "colour_ratio": colour_ratio,
+                "interest_factor": black_ratio * colour_ratio**0.5 * 10e2,
+                "coverage": float(numpy.count_nonzero(dense)) / size,
+                "entropy": float(entropy), "dimension": box_dimension(dense)}
+
+    def save_hdr(self, filename):
+        """
+        save the raw radiance of the image, and its samples per pixel, to a
+        compressed numpy file, so it can be tone mapped again without being
+        rendered again.
+        """
+        atomic_savez(filename, data=self.view(), iterations=self.iterations)
 
-    def save(self, filename):
+    def save(self, filename, bit_depth=8, level=PNG_COMPRESSION_LEVEL, strategy=PNG_COMPRESSION_STRATEGY, **tone):
         """
-        save the image to given filename using zlib's compressor
+        save the image to given filename as an 8 or 16 bit per channel PNG,
+        using zlib's compressor with the given level and strategy. Each
+        block of rows is compressed and written as its own IDAT chunk. Any
+        tone mapping options are passed on to display_blocks.
         """
+        if bit_depth not in (8, 16):
+            raise ValueError("bit_depth must be 8 or 16")
+        maximum = 2 ** bit_depth - 1
+        channel_type = ">u2" if bit_depth == 16 else numpy.uint8
+
         with open(filename, "wb") as f:
             f.write(bytes(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10)))
-            output_chunk(f, "IHDR".encode("utf-8"), struct.pack("!2I5B", self.width, self.height, 8, 2, 0, 0, 0))
-            compressor = zlib.compressobj()
-            data = array("B")
-            pixels = self.display_pixels()
-            for y in range(self.height):
-                data.append(0)
-                for x in range(self.width):
-                    for channel in range(3):
-                        data.append(min(255, max(0, int(pixels.__next__() * 255.0 + 0.5))))
-            compressed = compressor.compress(data.tostring())
-            flushed = compressor.flush()
-            output_chunk(f, "IDAT".encode("utf-8"), compressed + flushed)
+            output_chunk(f, "IHDR".encode("utf-8"), struct.pack("!2I5B", self.width, self.height, bit_depth, 2, 0, 0, 0))
+            compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy)
+            for pixels in self.display_blocks(**tone):
+                pixels *= maximum
+                pixels += 0.5
+                numpy.clip(pixels, 0, maximum, out=pixels)
+
+                # each scanline starts with filter type 0
+                data = numpy.zeros((len(pixels), 1 + self.width * 3 * bit_depth // 8), dtype=numpy.uint8)
+                data[:, 1:] = pixels.astype(channel_type).reshape(len(pixels), -1).view(numpy.uint8)
+                compressed = compressor.compress(data.tobytes())
+                if compressed:
+                    output_chunk(f, "IDAT".encode("utf-8"), compressed)
+            output_chunk(f, "IDAT".encode("utf-8"), compressor.flush())
             output_chunk(f, "IEND".encode("utf-8"), "".encode("utf-8"))
 
+def atomic_savez(filename, **arrays):
+    """
+    save arrays to a compressed numpy file, writing it to a temporary file
+    first and then moving that into place, so it is never left half written
+    """
+    with open(filename + ".tmp", "wb") as f:
+        numpy.savez_compressed(f, **arrays)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_hdr(filename):
+    """
+    load an image saved by Image.save_hdr
+    """
+    with numpy.load(filename) as f:
+        data = f["data"]
+        im = Image(data.shape[1], data.shape[0], float(f["iterations"]), data.dtype)
+        im.view()[...] = data
+    return im
+
+
+def box_dimension(hit):
+    """
+    box-counting dimension of a 2D boolean array: the slope of the log of
+    the number of boxes containing a True against the log of the number of
+    boxes across, halving the boxes until fewer than DIMENSION_MIN_BOXES
+    fit across
+    """
+    counts, across = [], []
+    while min(hit.shape) >= DIMENSION_MIN_BOXES:
+        counts.append(numpy.count_nonzero(hit))
+        across.append(min(hit.shape))
+        h, w = hit.shape[0] // 2, hit.shape[1] // 2
+        hit = hit[:h * 2, :w * 2].reshape(h, 2, w, 2).any(axis=(1, 3))
+    if len(counts) < 2 or counts[-1] == 0:
+        return 0.0
+    return float(numpy.polyfit(numpy.log(across), numpy.log(counts), 1)[0])
+
+
+def box_blur(a, r):
+    """
+    mean of each (2r+1) x (2r+1) square of a (height, width, channels) array,
+    with the edges of the array extended
+    """
+    for axis in (0, 1):
+        pad = [(0, 0)] * a.ndim
+        pad[axis] = (r + 1, r)
+        c = numpy.cumsum(numpy.pad(a, pad, mode="edge"), axis=axis)
+        n = a.shape[axis]
+        a = (numpy.take(c, numpy.arange(2 * r + 1, n + 2 * r + 1), axis=axis)
+             - numpy.take(c, numpy.arange(n), axis=axis)) / (2 * r + 1)
+    return a
+
+
 def output_chunk(f, chunk_type, data):
     """
     give chunks of packed image data for saving to file
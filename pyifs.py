@@ -1,5 +1,4 @@
 import config, getopt, os, random, sys
-from ifs import get_seed, IFSI
 
 def print_help():
     print("""
@@ -7,15 +6,33 @@ def print_help():
     --headless: Run headless (without graphical interface)
     -w, --width: Image width
     -h, --height: Image height
+    -j, --workers: Number of processes to render with, or headless, images to render at once
+    --burn-in: Iterations of each point to run before plotting it
+    --reseed: Restart points that hit a singularity from a new random point
+    --oversample: Render at this many times the width and height, then scale down
+    --previews: Number of half-size previews to save with each image
+    --blur: Largest radius of density estimation filtering, or 0 for none
+    --hdr: Also save the raw radiance of each image, to tone map again with tonemap.py
+    --cache: Directory to keep renders in, to reuse when rendering the same image again
+    --engine: Render engine, numpy, numba or python (default: numba if installed, else numpy)
+    --passes: Number of passes, or the most passes with --tolerance or --time-limit
+    --tolerance: Stop once a pass changes the image by less than this (e.g. 0.05)
+    --time-limit: Stop before a pass would take the render over this many seconds
 
     Headless options
-    -c, --count: Number of images to create
+    -c, --count: Number of images to create, split 10:1 between training and validation
+    -o, --output: Directory for the dataset and its manifest
+    --search-workers: Number of processes searching for seeds
+    --render-workers: Number of processes rendering images (default: --workers)
+    --batch-seed: Seed for a reproducible dataset
+    --stats-log: File to append the stats of each render to, as JSON lines
     """)
 
 # First, process command line args
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "?cwh",
-                 ["help","headless","count","width","height"])
+    opts, args = getopt.getopt(sys.argv[1:], "?c:w:h:j:o:",
+                 ["help","headless","reseed","burn-in=","oversample=","previews=","blur=","hdr","cache=","count=","width=","height=","workers=","output=",
+                  "search-workers=","render-workers=","batch-seed=","stats-log=","engine=","passes=","tolerance=","time-limit="])
 except getopt.error as msg:
     sys.stdout = sys.stderr
     print(msg)
@@ -24,19 +41,58 @@ except getopt.error as msg:
 
 # Set default values, then correct as needed per arg
 HEADLESS = False
+workers_given = render_workers_given = False
 for opt, arg in opts:
     if opt in ["-?","--help"]:
-        print_help(sys.argv[0])
+        print_help()
         sys.exit(0)
     if opt in ["--headless"]:
         HEADLESS = True
     if opt in ["-c","--count"]:
-        config.image_count = int(arg)
+        count = int(arg)
+        config.dataset = [("training", count - count // 11), ("validation", count // 11)]
         HEADLESS = True
     if opt in ["-w","--width"]:
         config.width = int(arg)
     if opt in ["-h","--height"]:
         config.height = int(arg)
+    if opt in ["-j","--workers"]:
+        config.workers = int(arg)
+        workers_given = True
+    if opt in ["-o","--output"]:
+        config.dataset_dir = arg
+        HEADLESS = True
+    if opt in ["--burn-in"]:
+        config.burn_in = int(arg)
+    if opt in ["--reseed"]:
+        config.reseed = True
+    if opt in ["--oversample"]:
+        config.oversample = int(arg)
+    if opt in ["--previews"]:
+        config.previews = int(arg)
+    if opt in ["--blur"]:
+        config.blur = int(arg)
+    if opt in ["--hdr"]:
+        config.hdr = True
+    if opt in ["--cache"]:
+        config.cache_dir = arg
+    if opt in ["--engine"]:
+        config.engine = arg
+    if opt in ["--passes"]:
+        config.passes = int(arg)
+    if opt in ["--tolerance"]:
+        config.tolerance = float(arg)
+    if opt in ["--time-limit"]:
+        config.time_limit = float(arg)
+    if opt in ["--search-workers"]:
+        config.search_workers = int(arg)
+    if opt in ["--render-workers"]:
+        config.render_workers = int(arg)
+        render_workers_given = True
+    if opt in ["--batch-seed"]:
+        config.batch_seed = int(arg)
+    if opt in ["--stats-log"]:
+        config.stats_log = arg
 # if args and args[0] != '-':
 #     with open(args[0], 'rb') as f:
 #         func(f, sys.stdout.buffer)
@@ -45,33 +101,44 @@ for opt, arg in opts:
 
 
 if HEADLESS:
-    # Create small images as dataset for classifier and GAN experiments
-    for subdir, num in [("training",500),("validation",50)]:
-        for i in range(num):
-            path = os.path.join("data", subdir, "ifs")
-            if not os.path.exists(path): os.makedirs(path)
-            filename = os.path.join(path, "%03d"%i + ".png")
-            # Create new ONLY if that filename hasn't been used yet
-            # (for manual data sanitation, selective regeneration)
-            if not os.path.exists(filename):
-                ifsi = IFSI(config.width, config.height, config.iterations,
-                            config.num_points, config.num_transforms,
-                            config.moebius_chance, config.spherical_chance,
-                            get_seed(config.num_transforms, config.moebius_chance,
-                            config.spherical_chance), filename=filename)
-                ifsi.render().save_image()
+    from batch import dataset_jobs, run_batch
+
+    # Each image renders in a single process of the render pool, which
+    # can't start workers of its own, so --workers sizes that pool instead
+    if workers_given:
+        if render_workers_given:
+            print("Ignoring --workers, as --render-workers is given", file=sys.stderr)
+        else:
+            config.render_workers = config.workers
+            print("Rendering %d images at once, each in one process" % config.workers, file=sys.stderr)
+
+    # Create small images as dataset for classifier and GAN experiments.
+    # Existing images are kept, so removing some by hand and running again
+    # regenerates just those.
+    jobs = dataset_jobs(config.dataset_dir, config.dataset, config.width, config.height,
+                        config.iterations, config.num_points, config.num_transforms,
+                        config.moebius_chance, config.spherical_chance, config.batch_seed,
+                        config.burn_in, config.reseed, config.oversample)
+    stats = run_batch(jobs, os.path.join(config.dataset_dir, "manifest.jsonl"),
+                      config.search_workers, config.render_workers, config.stats_log,
+                      engine=config.engine, passes=config.passes,
+                      tolerance=config.tolerance, time_limit=config.time_limit,
+                      cache=config.cache_dir,
+                      save={"previews": config.previews, "blur": config.blur, "hdr": config.hdr})
+    print(stats.report())
 
 else:
-    # Set up gui
+    # Set up gui. Matplotlib is only imported once there's an image to show
     import PySimpleGUI as sg
-    from matplotlib import pyplot as plt
-    plt.ion()
+    from background import BackgroundRender, BackgroundSeedSearch
+    from ifs import load_parameters, IFSI
 
     # Set default colour scheme for windows
     sg.ChangeLookAndFeel('GreenTan')
 
-    # Get a starting seed
-    seed = get_seed(config.num_transforms, config.moebius_chance, config.spherical_chance)
+    # The seed, which is searched for in the background once the window is
+    # open, so it doesn't hang before it appears
+    seed = None
 
     # Top menu buttons
     menu_def = [
@@ -84,42 +151,94 @@ else:
         [sg.Menu(menu_def, tearoff=True)],
         [
             sg.Text("Width", size=(8, 1), pad=(0,0)),
-            sg.InputText(config.width, key="width", size=(10, 1), pad=(0,0)),
+            sg.InputText(config.width, key="width", size=(10, 1), pad=(0,0), enable_events=True),
             sg.Text("Iterations", size=(10  , 1), pad=(10,0)),
-            sg.InputText(config.iterations, key="iterations", size=(15, 20), pad=(0,0))
+            sg.InputText(config.iterations, key="iterations", size=(15, 20), pad=(0,0), enable_events=True)
         ],
         [
             sg.Text("Height", size=(8, 1), pad=(0,0)),
-            sg.InputText(config.height, key="height", size=(10, 1), pad=(0,0)),
+            sg.InputText(config.height, key="height", size=(10, 1), pad=(0,0), enable_events=True),
             sg.Text("Num Points", size=(10, 1), pad=(10,0)),
-            sg.InputText(config.num_points, key="num_points", size=(15, 20), pad=(0,0))
+            sg.InputText(config.num_points, key="num_points", size=(15, 20), pad=(0,0), enable_events=True)
         ],
         [
             sg.Text("Number of Transforms", size=(15, 2), pad=(0,0)),
-            sg.Slider(range=(1, 10), orientation="h", size=(20, 20), default_value=config.num_transforms, key="num_transforms")
+            sg.Slider(range=(1, 10), orientation="h", size=(20, 20), default_value=config.num_transforms, key="num_transforms", enable_events=True)
         ],
         [
             sg.Text("Moebius Base Probability", size=(15, 2), pad=(0,0)),
-            sg.Slider(range=(0, 100), orientation="h", size=(20, 20), default_value=int(config.moebius_chance*100), key="moebius_chance")
+            sg.Slider(range=(0, 100), orientation="h", size=(20, 20), default_value=int(config.moebius_chance*100), key="moebius_chance", enable_events=True)
         ],
         [
             sg.Text("Spherical Base Probability", size=(15, 2), pad=(0,0)),
-            sg.Slider(range=(0, 100), orientation="h", size=(20, 20), default_value=int(config.spherical_chance*100), key="spherical_chance")
+            sg.Slider(range=(0, 100), orientation="h", size=(20, 20), default_value=int(config.spherical_chance*100), key="spherical_chance", enable_events=True)
         ],
         [
             sg.Button("Random Seed"),
-            sg.InputText(seed, key="seed", size=(30,1), enable_events=True)
+            sg.InputText("", key="seed", size=(30,1), enable_events=True)
         ],
         [
             sg.Button("Render to File"),
+            sg.Button("Cancel"),
             sg.ProgressBar(config.num_points, orientation="h", size=(20,20), key="progress")
         ]
     ]
 
+    # Events that change the image, and restart the preview
+    parameter_events = ["width", "height", "iterations", "num_points", "num_transforms",
+                        "moebius_chance", "spherical_chance", "seed", "seed-found"]
+
+    def make_ifsi(values, preview=False):
+        """
+        IFSI for the parameters in the window, or a small, quick version of
+        it for previewing. There's no IFS until there's a seed.
+        """
+        if seed is None:
+            raise ValueError("No seed yet")
+        width, height = int(values["width"]), int(values["height"])
+        iterations, num_points = int(values["iterations"]), int(values["num_points"])
+        if preview:
+            scale = min(1.0, config.preview_size / float(max(width, height)))
+            width, height = max(1, int(width * scale)), max(1, int(height * scale))
+            iterations = min(iterations, config.preview_iterations)
+            num_points = min(num_points, config.preview_points)
+        return IFSI(width, height, iterations, num_points,
+                    int(values["num_transforms"]), int(values["moebius_chance"])/100,
+                    int(values["spherical_chance"])/100, seed,
+                    burn_in=config.burn_in, reseed=config.reseed,
+                    oversample=1 if preview else config.oversample, ifs=ifs)
+
+    def show(image):
+        from matplotlib import pyplot as plt
+        plt.ion()
+        plt.clf()
+        plt.imshow(image)
+        plt.gcf().canvas.draw_idle()
+        plt.gcf().canvas.flush_events()
+
+    # The render and the seed search running in the background, if any
+    render = None
+    seed_search = None
+
+    def search_seed(num_transforms, moebius_chance, spherical_chance):
+        """
+        Start a background search for a seed, returning the search
+        """
+        search = BackgroundSeedSearch(main_window, num_transforms, moebius_chance, spherical_chance)
+        search.start()
+        return search
+
+    # The parameters of an IFS opened from a file, which is used instead of
+    # the one the seed makes until another seed is chosen
+    ifs = None
+
     # Create and open the main window using the above layout
     main_window = sg.Window("PyIFS", main_layout)
     main_window.Finalize()
 
+    # Search for a starting seed, previewed once it's found
+    seed_search = search_seed(config.num_transforms, config.moebius_chance, config.spherical_chance)
+
     # Main window event loop
     while True:
         event, values = main_window.Read()
@@ -127,7 +246,22 @@ else:
             break  # exit the program
 
         if event == "Random Seed":
-            seed = get_seed(int(values["num_transforms"]), int(values["moebius_chance"])/100, int(values["spherical_chance"])/100)
+            # Search in the background, and preview the seed once it's found
+            seed_search = search_seed(int(values["num_transforms"]),
+                                      int(values["moebius_chance"])/100,
+                                      int(values["spherical_chance"])/100)
+            continue
+
+        if event == "seed-found":
+            job, found = values[event]
+            if job is not seed_search:
+                # Cancelled, or replaced by another search
+                continue
+            seed_search = None
+            if found is None:
+                sg.popup("The seed search failed: " + str(job.error))
+                continue
+            seed = found
             main_window.Element("seed").Update(str(seed))
 
         if event == "seed":
@@ -135,30 +269,96 @@ else:
                 seed = int(values["seed"])
             except ValueError:
                 seed = 0
+            seed_search = None
 
-        if event == "Render to File":
-            ifsi = IFSI(int(values["width"]), int(values["height"]),
-                        int(values["iterations"]), int(values["num_points"]),
-                        int(values["num_transforms"]), int(values["moebius_chance"])/100,
-                        int(values["spherical_chance"])/100, seed)
-            bar = main_window.Element("progress")
-            bar.UpdateBar(0, int(values["num_points"]))
-            if ifsi.render(bar=bar):
-                ifsi.save_image()
-                ifsi.save_parameters()
-                plt.imshow(ifsi.get_image())
-                plt.draw()
-                image_window = sg.Window(ifsi.filename, [[sg.Image(ifsi.filename)]])
-                image_window.Finalize()
-
-        if event.startswith("editor"):
+        if event in ["seed", "seed-found"]:
+            ifs = None
+
+        if event == "Open Parameters":
+            path = sg.popup_get_file("Open Parameters", file_types=(("Parameters", "*.json"),))
+            if path:
+                opened = load_parameters(path)
+                seed, ifs = opened.seed, opened.ifs.parameters()
+                seed_search = None
+                values.update(width=opened.width, height=opened.height, iterations=opened.iterations,
+                              num_points=opened.num_points, num_transforms=opened.num_transforms,
+                              moebius_chance=int(opened.moebius_chance*100),
+                              spherical_chance=int(opened.spherical_chance*100), seed=seed)
+                for key in parameter_events[:-1]:
+                    main_window.Element(key).Update(values[key])
+                # Preview it
+                event = "seed"
+
+        if event == "Save Parameters":
+            path = sg.popup_get_file("Save Parameters", save_as=True, default_extension=".json",
+                                     file_types=(("Parameters", "*.json"),))
+            if path:
+                try:
+                    make_ifsi(values).save_parameters(path)
+                except ValueError:
+                    sg.popup("The parameters need to be numbers")
+
+        elif event in parameter_events or event == "Render to File":
+            # Replace whatever is rendering with a quick preview, or the
+            # full render to file
+            if render is not None:
+                render.cancel()
+                render = None
+            main_window.Element("progress").UpdateBar(0)
+            try:
+                if event == "Render to File":
+                    render = BackgroundRender(make_ifsi(values), main_window,
+                                              save={"previews": config.previews, "blur": config.blur,
+                                                    "hdr": config.hdr},
+                                              engine=config.engine, workers=config.workers, passes=config.passes,
+                                              tolerance=config.tolerance, time_limit=config.time_limit,
+                                              cache=config.cache_dir)
+                else:
+                    render = BackgroundRender(make_ifsi(values, preview=True), main_window,
+                                              engine=config.engine)
+            except ValueError:
+                # Not a number, probably while it is being typed
+                pass
+            else:
+                render.start()
+
+        elif event == "Cancel":
+            if render is not None:
+                render.cancel()
+                render = None
+            seed_search = None
+            main_window.Element("progress").UpdateBar(0)
+
+        elif event == "render-snapshot":
+            job, progress, total, image = values[event]
+            if job is render:
+                if total:
+                    main_window.Element("progress").UpdateBar(progress, total)
+                else:
+                    main_window.Element("progress").UpdateBar(progress)
+                show(image)
+
+        elif event == "render-done":
+            job, ifsi = values[event]
+            if job is render:
+                render = None
+                if job.error is not None:
+                    sg.popup("The render failed: " + str(job.error))
+                if ifsi:
+                    show(ifsi.get_image())
+                    if job.save is not None:
+                        ifsi.save_parameters()
+                        image_window = sg.Window(ifsi.filename, [[sg.Image(ifsi.filename)]])
+                        image_window.Finalize()
+
+        elif event.startswith("editor"):
             x, y = values["editor"]
             if event.endswith("+UP"):
                 print(f"UP {values['editor']}")
             else:
                 print(f"DOWN {values['editor']}")
 
-        else:
+        elif event != "Open Parameters":
             # Print unrecognized events.
             # Mainly for debugging; shouldn't normally happen.
             print(event, values)
@@ -0,0 +1,55 @@
+"""
+Random numbers for rendering, drawn from a NumPy generator in blocks.
+
+The chaos game takes a few random numbers per step. Drawing each one from
+random.Random costs a Python call per number (and several for uniform and
+choice), so RandomStream draws them BLOCK_SIZE at a time from a NumPy
+generator and hands them out one by one. Every engine uses the same kind of
+generator, made by generator, so a seed or SeedSequence always means the
+same numbers, and spawn splits a stream into independent ones for workers.
+"""
+import itertools, numpy
+
+
+# The bit generator behind every stream: PCG64, as numpy.random.default_rng
+BIT_GENERATOR = numpy.random.PCG64
+
+# Random numbers drawn from the generator at a time
+BLOCK_SIZE = 4096
+
+
+def generator(seed=None):
+    """
+    NumPy generator for a seed or SeedSequence, for drawing arrays of
+    random numbers
+    """
+    return numpy.random.Generator(BIT_GENERATOR(seed))
+
+
+class RandomStream:
+    """
+    Stand-in for random.Random, with the methods rendering uses, that takes
+    its numbers from a NumPy generator a block at a time.
+    random() is a bound C iterator, so a number costs no more than a list
+    lookup. The generator is available as self.generator for whole arrays.
+    """
+    def __init__(self, seed=None, block=BLOCK_SIZE):
+        self.generator = generator(seed)
+        self.block = block
+        self.random = itertools.chain.from_iterable(self.blocks()).__next__
+
+    def blocks(self):
+        while True:
+            yield self.generator.random(self.block).tolist()
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+    def spawn(self, n):
+        """
+        SeedSequences of n independent streams split off this one, e.g. one
+        for each worker. The same stream always splits the same way.
+        """
+        seq = self.generator.bit_generator.seed_seq
+        return [numpy.random.SeedSequence(seq.entropy, spawn_key=seq.spawn_key + (i,), pool_size=seq.pool_size)
+                for i in range(n)]
@@ -0,0 +1,87 @@
+"""
+Tone map the raw radiance of a rendered image, saved with
+IFSI.save_image(hdr=True) or --hdr, to PNG again without rendering it, e.g.
+
+    python3 tonemap.py --exposure 2 --gamma 0.6 -o bright.png image.npz
+"""
+import getopt, os, sys
+from image import load_hdr, GAMMA_ENCODE, DISPLAY_LUMINANCE_MAX, TONE_OPERATORS
+
+
+def tonemap(hdr_path, output=None, bit_depth=8, blur=0, previews=0, **tone):
+    """
+    Save the image in hdr_path as a PNG, by default next to it as
+    name.tonemapped.png, so as not to overwrite the render's own name.png,
+    along with any previews each half the size of the one before, named as
+    IFSI.preview_filename names them. blur is as in IFSI.save_image, and
+    any tone mapping options are passed on to Image.display_blocks.
+    Returns the filename of the image.
+    """
+    if output is None:
+        output = os.path.splitext(hdr_path)[0] + ".tonemapped.png"
+    im = load_hdr(hdr_path)
+    if blur:
+        im = im.density_blur(blur)
+    root, ext = os.path.splitext(output)
+    for i, level in enumerate(im.pyramid(previews)):
+        level.save(root + "." + str(i) + ext if i else output, bit_depth, **tone)
+    return output
+
+
+def print_help():
+    print("""
+    Usage: tonemap.py [options] image.npz ...
+
+    -?, --help: Display this list
+    -o, --output: File to save the PNG to (default: name.tonemapped.png next to name.npz, for a single file)
+    -e, --exposure: Multiply the radiance by this before tone mapping (default: 1)
+    -g, --gamma: Gamma to encode the image with (default: %s)
+    --operator: Tone mapping operator, one of %s (default: ward)
+    --luminance-max: Maximum luminance of the display for the ward operator (default: %s)
+    -b, --bit-depth: 8 or 16 bits per channel (default: 8)
+    --blur: Largest radius of density estimation filtering, or 0 for none
+    --previews: Number of half-size previews to save with each image
+    """ % (GAMMA_ENCODE, ", ".join(TONE_OPERATORS), DISPLAY_LUMINANCE_MAX))
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "?o:e:g:b:",
+                     ["help","output=","exposure=","gamma=","operator=","luminance-max=","bit-depth=",
+                      "blur=","previews="])
+    except getopt.error as msg:
+        sys.stdout = sys.stderr
+        print(msg)
+        print_help()
+        sys.exit(2)
+
+    output, bit_depth, blur, previews, tone = None, 8, 0, 0, {}
+    for opt, arg in opts:
+        if opt in ["-?","--help"]:
+            print_help()
+            sys.exit(0)
+        if opt in ["-o","--output"]:
+            output = arg
+        if opt in ["-e","--exposure"]:
+            tone["exposure"] = float(arg)
+        if opt in ["-g","--gamma"]:
+            tone["gamma"] = float(arg)
+        if opt in ["--operator"]:
+            if arg not in TONE_OPERATORS:
+                print("Unknown tone mapping operator: " + arg, file=sys.stderr)
+                sys.exit(2)
+            tone["operator"] = arg
+        if opt in ["--luminance-max"]:
+            tone["luminance_max"] = float(arg)
+        if opt in ["-b","--bit-depth"]:
+            bit_depth = int(arg)
+        if opt in ["--blur"]:
+            blur = int(arg)
+        if opt in ["--previews"]:
+            previews = int(arg)
+
+    if not args or (output is not None and len(args) > 1):
+        print_help()
+        sys.exit(2)
+    for path in args:
+        print(tonemap(path, output, bit_depth, blur, previews, **tone))
@@ -1,14 +1,30 @@
 import random, baseforms
 import numpy as np
-from math import cos, sin, pi, atan, atan2, sqrt
+from math import atan, atan2, copysign, cos, nan, pi, sin, sqrt
 
 
-# r = sqrt(px**2 + py**2)
+# r = sqrt(px*px + py*py)
 # theta = atan(px/py)
 # phi = atan(py/px)
 
 
+def angle(px, py):
+    """
+    theta, atan(px/py), without raising when py is 0, but giving +-pi/2, or
+    NaN at the origin, as numpy's arctan(px/py) does in the other engines
+    """
+    if py:
+        return atan(px/py)
+    if px:
+        # px/0.0 is infinite with the sign of px times the sign of the zero
+        return copysign(pi/2, px) * copysign(1.0, py)
+    return nan
+
+
+@baseforms.register
 class Linear(baseforms.Transform):
+    __slots__ = ("coef_a", "coef_b", "coef_c", "coef_d")
+
     def __init__(self, rng):
         super(Linear, self).__init__(rng)
         self.coef_a = rng.uniform(-1, 1)
@@ -19,8 +35,14 @@ class Linear(baseforms.Transform):
     def transform(self, px, py):
         return (self.coef_a * px + self.coef_b * py, self.coef_c * px + self.coef_d * py)
 
+    def transform_array(self, px, py, rng):
+        return self.transform(px, py)
 
+
+@baseforms.register
 class Moebius(baseforms.ComplexTransform):
+    __slots__ = ("coef_a", "coef_b", "coef_c", "coef_d")
+
     def __init__(self, rng):
         super(Moebius, self).__init__(rng)
         self.coef_a = complex(rng.uniform(-1, 1), rng.uniform(-1, 1))
@@ -31,8 +53,14 @@ class Moebius(baseforms.ComplexTransform):
     def f(self, z):
         return (self.coef_a * z + self.coef_b) / (self.coef_c * z + self.coef_d)
 
+    def f_array(self, z, rng):
+        return self.f(z)
 
+
+@baseforms.register
 class InverseJulia(baseforms.ComplexTransform):
+    __slots__ = ("c",)
+
     def __init__(self, rng):
         super(InverseJulia, self).__init__(rng)
         r = sqrt(self.rng.random()) * 0.4 + 0.8
@@ -42,132 +70,241 @@ class InverseJulia(baseforms.ComplexTransform):
     def f(self, z):
         z2 = self.c - z
         theta = atan2(z2.imag, z2.real) * 0.5
-        sqrt_r = self.rng.choice([1, -1]) * ((z2.imag * z2.imag + z2.real * z2.real) ** 0.25)
+        sqrt_r = (z2.imag * z2.imag + z2.real * z2.real) ** 0.25
+        if self.rng.random() < 0.5:
+            sqrt_r = -sqrt_r
         return complex(sqrt_r * cos(theta), sqrt_r * sin(theta))
 
+    def f_array(self, z, rng):
+        z2 = self.c - z
+        theta = np.angle(z2) * 0.5
+        sign = rng.integers(0, 2, len(z)) * 2 - 1
+        sqrt_r = sign * (z2.imag * z2.imag + z2.real * z2.real) ** 0.25
+        return sqrt_r * np.exp(1j * theta)
 
+
+@baseforms.register
 class Bubble(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Bubble, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
+        r = sqrt(px*px + py*py)
         r2 = 4 / (r**2 + 4)
         return r2*px, r2*py
 
+    def transform_array(self, px, py, rng):
+        r2 = 4 / (px**2 + py**2 + 4)
+        return r2*px, r2*py
+
 
+@baseforms.register
 class Sinusoidal(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Sinusoidal, self).__init__(rng)
 
     def transform(self, px, py):
         return sin(px), sin(py)
 
+    def transform_array(self, px, py, rng):
+        return np.sin(px), np.sin(py)
 
+
+@baseforms.register
 class Spherical(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Spherical, self).__init__(rng)
 
     def transform(self, px, py):
-        r2 = sqrt(px**2 + py**2)**2
+        r2 = sqrt(px*px + py*py)**2
+        return px/r2, py/r2
+
+    def transform_array(self, px, py, rng):
+        r2 = px**2 + py**2
         return px/r2, py/r2
 
 
+@baseforms.register
 class Horseshoe(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Horseshoe, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
+        r = sqrt(px*px + py*py)
+        return (px-py)*(px+py)/r, 2*px*py/r
+
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
         return (px-py)*(px+py)/r, 2*px*py/r
 
 
+@baseforms.register
 class Polar(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Polar, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
+        return theta/pi, r-1
+
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
         return theta/pi, r-1
 
 
+@baseforms.register
 class Handkerchief(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Handkerchief, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         return r * sin(theta+r), r * cos(theta-r)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        return r * np.sin(theta+r), r * np.cos(theta-r)
+
 
+@baseforms.register
 class Heart(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Heart, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         return r * sin(theta*r), -r * cos(theta*r)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        return r * np.sin(theta*r), -r * np.cos(theta*r)
+
 
+@baseforms.register
 class Disc(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Disc, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        thpi = atan(px/py)/pi
+        r = sqrt(px*px + py*py)
+        thpi = angle(px, py)/pi
         return thpi * sin(pi*r), thpi * cos(pi*r)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        thpi = np.arctan(px/py)/pi
+        return thpi * np.sin(pi*r), thpi * np.cos(pi*r)
 
+
+@baseforms.register
 class Spiral(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Spiral, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         return (cos(theta)+sin(r))/r, (sin(theta)-cos(r))/r
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        return (np.cos(theta)+np.sin(r))/r, (np.sin(theta)-np.cos(r))/r
 
+
+@baseforms.register
 class Hyperbolic(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Hyperbolic, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         return sin(theta)/r, r * cos(theta)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        return np.sin(theta)/r, r * np.cos(theta)
+
 
+@baseforms.register
 class Diamond(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Diamond, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         return sin(theta)*cos(r), cos(theta)*sin(r)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        return np.sin(theta)*np.cos(r), np.cos(theta)*np.sin(r)
+
 
+@baseforms.register
 class Ex(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Ex, self).__init__(rng)
 
     def transform(self, px, py):
-        r = sqrt(px**2 + py**2)
-        theta = atan(px/py)
+        r = sqrt(px*px + py*py)
+        theta = angle(px, py)
         p03 = sin(theta + r)**3
         p13 = cos(theta - r)**3
         return r * (p03 + p13), r * (p03 - p13)
 
+    def transform_array(self, px, py, rng):
+        r = np.sqrt(px*px + py*py)
+        theta = np.arctan(px/py)
+        p03 = np.sin(theta + r)**3
+        p13 = np.cos(theta - r)**3
+        return r * (p03 + p13), r * (p03 - p13)
+
 
+@baseforms.register
 class Swirl(baseforms.Transform):
+    __slots__ = ()
+
     def __init__(self, rng):
         super(Swirl, self).__init__(rng)
 
     def transform(self, px, py):
-        r2 = sqrt(px**2 + py**2)**2
+        r2 = sqrt(px*px + py*py)**2
         return px*sin(r2) - py*cos(r2), px*cos(r2) + py*sin(r2)
+
+    def transform_array(self, px, py, rng):
+        r2 = px**2 + py**2
+        return px*np.sin(r2) - py*np.cos(r2), px*np.cos(r2) + py*np.sin(r2)